@@ -1,4 +1,5 @@
 import os
+import re
 import boto3
 import sqlite3
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
@@ -8,10 +9,25 @@ from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Length
 from werkzeug.security import generate_password_hash, check_password_hash
 from botocore.exceptions import ClientError
+import time
+import shutil
 import tempfile
-import paramiko
 import logging
+from functools import lru_cache
 from datetime import datetime
+import db
+import jobs
+import metrics
+import streaming
+import ssh_pool
+import compression
+import chunk_store
+import file_index
+import catalog
+import s3_transfer
+import backup_groups
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -30,6 +46,26 @@ SSH_USER = "root"
 SSH_KEY_PATH = "D:\\backup-script_app\\set_private1"  # Replace with the actual path to the private key
 MONGO_DB_NAME = "test_db"  # Replace with your MongoDB name
 ROOT_PATH = "/home/captain/application/sharklaravel"  # Hardcoded root path
+# 'stream' pipes tar straight into an S3 multipart upload; 'file' keeps the copy/tar/download flow;
+# 'incremental' uploads only new content-defined chunks plus a per-backup manifest
+BACKUP_MODES = ('stream', 'file', 'incremental')
+BACKUP_MODE = os.getenv('BACKUP_MODE', 'stream')
+# 'stream' pipes the S3 object into a remote tar; 'file' downloads and re-uploads it first
+RESTORE_MODE = os.getenv('RESTORE_MODE', 'stream')
+# 'smart' reuses the latest backup or takes a hardlink snapshot before a restore; 'full' always runs a backup
+PRE_RESTORE_SNAPSHOT = os.getenv('PRE_RESTORE_SNAPSHOT', 'smart')
+# Incremental backups restore application files as a delta against the live tree
+DELTA_RESTORE = os.getenv('DELTA_RESTORE', 'true').lower() == 'true'
+# mongorestore parallelism: collections restored at once, and insert workers per collection
+MONGORESTORE_PARALLEL_COLLECTIONS = int(os.getenv('MONGORESTORE_PARALLEL_COLLECTIONS', '4'))
+MONGORESTORE_INSERTION_WORKERS = int(os.getenv('MONGORESTORE_INSERTION_WORKERS', '2'))
+# File-mode archives are downloaded into a per-job directory here and uploaded from it
+BACKUP_STAGING_DIR = os.getenv('BACKUP_STAGING_DIR', os.path.join(tempfile.gettempdir(), 'backup_staging'))
+# Users kept in the load_user cache
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '256'))
+# Bearer token that lets scrapers, which cannot log in, read /metrics. Without
+# it /metrics is only served to logged-in users, since it lists SSH hosts.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
 # Load environment variables
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
@@ -46,23 +82,23 @@ s3_client = boto3.client(
 
 # SQLite database setup
 def init_db():
-    conn = sqlite3.connect('app_config.db')
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT NOT NULL UNIQUE,
-                        password TEXT NOT NULL
-                    )''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS backups (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        project_name TEXT NOT NULL,
-                        ssh_host TEXT NOT NULL,
-                        backup_path TEXT NOT NULL,
-                        root_path TEXT NOT NULL,
-                        timestamp TEXT NOT NULL
-                    )''')
-    conn.commit()
-    conn.close()
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            username TEXT NOT NULL UNIQUE,
+                            password TEXT NOT NULL
+                        )''')
+        db.init_backups_table(cursor)
+        jobs.init_jobs_table(cursor)
+        chunk_store.init_chunks_table(cursor)
+        file_index.init_file_index_tables(cursor)
+        s3_transfer.init_transfer_tables(cursor)
+        backup_groups.init_group_tables(cursor)
+        catalog.init_catalog_tables(cursor)
+        metrics.init_metrics_tables(cursor)
+        db.migrate(cursor)
+        conn.commit()
 
 init_db()
 
@@ -76,14 +112,25 @@ class User(UserMixin):
 # Flask-Login User Loader
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect('app_config.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    if user:
-        return User(user[0], user[1], user[2])
-    return None
+    try:
+        user = fetch_user(str(user_id))
+    except KeyError:
+        return None
+    return User(user[0], user[1], user[2])
+
+# load_user runs on every authenticated request; users are never updated or
+# deleted by the app, so their rows can be cached for the life of the process.
+# Unknown ids raise instead of returning None, since lru_cache does not keep
+# exceptions and a user registered later must still be found.
+@lru_cache(maxsize=USER_CACHE_SIZE)
+def fetch_user(user_id):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        user = cursor.fetchone()
+    if user is None:
+        raise KeyError(user_id)
+    return user
 
 # Login Form
 class LoginForm(FlaskForm):
@@ -123,19 +170,43 @@ def dashboard():
     # Logic for the dashboard functionality
     if request.method == 'POST':
         project_name = request.form.get('project_name')
-        ssh_host = request.form.get('ssh_host')
+        # Several comma- or newline-separated hosts make a backup group
+        hosts = backup_groups.parse_hosts(request.form.get('ssh_host'))
 
-        if not all([project_name, ssh_host]):
+        if not all([project_name, hosts]):
             flash('Please provide all required fields.', 'danger')
             return redirect(url_for('dashboard'))
 
-        # Perform backup logic
-        perform_backup(project_name, ssh_host)
-        flash(f'Backup process initiated for project: {project_name}', 'success')
+        mode = request.form.get('mode') or BACKUP_MODE
+        codec = request.form.get('compression') or compression.COMPRESSION_CODEC
+        level = request.form.get('compression_level', type=int)
+        if mode not in BACKUP_MODES:
+            flash(f'Unsupported backup mode: {mode}', 'danger')
+            return redirect(url_for('dashboard'))
+        if codec not in compression.CODECS:
+            flash(f'Unsupported compression codec: {codec}', 'danger')
+            return redirect(url_for('dashboard'))
+        try:
+            compression.check_level(codec, level)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('dashboard'))
+
+        # Queue the backup; it runs on the job worker pool
+        if len(hosts) > 1:
+            group_id = backup_groups.create_group(project_name, hosts,
+                                                  request.form.get('group_parallelism', type=int))
+            job_ids = queue_group_hosts(project_name, group_id, mode=mode, codec=codec, level=level)
+            flash(f'Backup group {group_id} queued for project: {project_name} on {len(hosts)} hosts '
+                  f'(jobs {", ".join(map(str, job_ids))} started, the rest follow as they finish)', 'success')
+        else:
+            job_id = jobs.enqueue_job('backup', project_name, hosts[0], mode=mode, codec=codec, level=level)
+            flash(f'Backup job {job_id} queued for project: {project_name}', 'success')
         return redirect(url_for('dashboard'))
 
     # Render the dashboard page
-    return render_template('index.html')
+    return render_template('index.html', codecs=compression.CODECS, default_codec=compression.COMPRESSION_CODEC,
+                           modes=BACKUP_MODES, default_mode=BACKUP_MODE)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -145,11 +216,10 @@ def login():
         username = form.username.data
         password = form.password.data
 
-        conn = sqlite3.connect('app_config.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
-        conn.close()
+        with db.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+            user = cursor.fetchone()
 
         if user and check_password_hash(user[2], password):
             login_user(User(user[0], user[1], user[2]))
@@ -166,100 +236,457 @@ def register():
         username = form.username.data
         password = generate_password_hash(form.password.data)
 
-        conn = sqlite3.connect('app_config.db')
-        cursor = conn.cursor()
-        try:
-            cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-            conn.commit()
-            flash("User registered successfully!", "success")
-            return redirect(url_for('login'))
-        except sqlite3.IntegrityError:
-            flash("Username already exists!", "danger")
-        finally:
-            conn.close()
+        with db.connect() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+                conn.commit()
+                flash("User registered successfully!", "success")
+                return redirect(url_for('login'))
+            except sqlite3.IntegrityError:
+                flash("Username already exists!", "danger")
     return render_template("register.html", form=form)
 
-def perform_backup(project_name, ssh_host):
+def perform_backup(project_name, ssh_host, job_id=None, mode=None, codec=None, level=None, group_id=None):
+    mode = mode or BACKUP_MODE
+    codec = codec or compression.COMPRESSION_CODEC
+    started = time.time()
     try:
         root_path = ROOT_PATH
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(ssh_host, username=SSH_USER, key_filename=SSH_KEY_PATH)
-            logging.info(f"Connected to {ssh_host} as {SSH_USER}")
-
+        with ssh_pool.connection(ssh_host, SSH_USER, SSH_KEY_PATH) as ssh:
             sanitized_project_name = project_name.replace(" ", "_")
-            combined_backup_path = "/tmp/combined_backup"
-            ssh.exec_command(f"mkdir -p {combined_backup_path}")
-
-            mongo_dump_command = f"mongodump --db {MONGO_DB_NAME} --out {combined_backup_path}/mongo_backup"
-            stdin, stdout, stderr = ssh.exec_command(mongo_dump_command)
-            if stdout.channel.recv_exit_status() != 0:
-                raise RuntimeError(f"MongoDB dump failed: {stderr.read().decode()}")
-            logging.info("MongoDB dump created.")
-
-            app_copy_command = f"cp -r {root_path} {combined_backup_path}/application"
-            stdin, stdout, stderr = ssh.exec_command(app_copy_command)
-            if stdout.channel.recv_exit_status() != 0:
-                raise RuntimeError(f"Application files copy failed: {stderr.read().decode()}")
-            logging.info("Application files copied.")
-
-            tar_filename = f"{sanitized_project_name}-backup-{datetime.now().strftime('%Y%m%d-%H%M%S')}.tar.gz"
-            remote_tar_path = f"/tmp/{tar_filename}"
-            tar_command = f"tar -czf {remote_tar_path} -C {combined_backup_path} ."
-            stdin, stdout, stderr = ssh.exec_command(tar_command)
-            if stdout.channel.recv_exit_status() != 0:
-                raise RuntimeError(f"Tar command failed: {stderr.read().decode()}")
-            logging.info(f"Backup archive created: {remote_tar_path}")
-
-            local_tar_path = os.path.join(temp_dir, tar_filename)
-            with ssh.open_sftp() as sftp:
-                sftp.get(remote_tar_path, local_tar_path)
-
-            upload_to_s3(local_tar_path, tar_filename, f"{PREFIX}{sanitized_project_name}/")
-
-            conn = sqlite3.connect('app_config.db')
-            cursor = conn.cursor()
-            cursor.execute('''INSERT INTO backups (project_name, ssh_host, backup_path, root_path, timestamp)
-                  VALUES (?, ?, ?, ?, ?)''',
-               (project_name, ssh_host, f"{PREFIX}{sanitized_project_name}/{tar_filename}", 
-                ROOT_PATH, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-
-            conn.commit()
-            conn.close()
+            timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            staged = staged_archive(job_id) if mode == 'file' else None
+            if staged:
+                # A resumed job reuses its interrupted run's archive, and with it the S3 key,
+                # so the upload continues from the parts already uploaded
+                timestamp = re.search(r'-backup-(\d{8}-\d{6})', os.path.basename(staged)).group(1)
+                logging.info(f"Resuming upload of staged archive {staged}")
+            # Group members run in the same second, so each host gets its own folder
+            backup_folder = sanitized_project_name
+            if group_id is not None:
+                backup_folder = f"{sanitized_project_name}@{ssh_host.replace(':', '_')}"
+            # Per-backup staging dir so concurrent jobs on one host do not collide.
+            # Streamed and incremental backups dump the database straight to S3 and stage nothing.
+            combined_backup_path = f"/tmp/combined_backup_{backup_folder}_{timestamp}"
+            if mode == 'file' and not staged:
+                stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {combined_backup_path}")
+                stdout.channel.recv_exit_status()
+
+                jobs.set_phase(job_id, 'dump')
+                mongo_dump_command = f"mongodump --db {MONGO_DB_NAME} --out {combined_backup_path}/mongo_backup"
+                stdin, stdout, stderr = ssh.exec_command(mongo_dump_command)
+                if stdout.channel.recv_exit_status() != 0:
+                    raise RuntimeError(f"MongoDB dump failed: {stderr.read().decode()}")
+                logging.info("MongoDB dump created.")
+
+            if mode == 'incremental':
+                codec = 'manifest'
+                extension = chunk_store.MANIFEST_EXTENSION
+            else:
+                extension = compression.archive_extension(codec)
+                compress_option = compression.tar_compress_option(codec, level)
+            tar_filename = f"{backup_folder}-backup-{timestamp}{extension}"
+            backup_key = f"{PREFIX}{backup_folder}/{tar_filename}"
+
+            jobs.set_phase(job_id, 'scan')
+            listing = file_index.scan_remote(ssh, root_path)
+            changes = file_index.diff_listing(listing, file_index.load_index(project_name, ssh_host))
+            logging.info(f"Changes since last backup: {len(changes['added'])} added, "
+                         f"{len(changes['modified'])} modified, {len(changes['deleted'])} deleted")
+            hashes = None
+
+            if mode == 'incremental':
+                hashes = incremental_backup(ssh, root_path, project_name, ssh_host, backup_key, listing, job_id)
+                cleanup_command = None
+            elif mode == 'stream':
+                stream_backup(ssh, root_path, backup_key, compress_option, job_id)
+                cleanup_command = None
+            else:
+                remote_tar_path = f"/tmp/{tar_filename}"
+                if staged:
+                    upload_staged_archive(staged, f"{PREFIX}{backup_folder}/", job_id)
+                else:
+                    copy_backup(ssh, root_path, combined_backup_path, remote_tar_path,
+                                tar_filename, f"{PREFIX}{backup_folder}/", compress_option, job_id)
+                cleanup_command = f"rm -rf {combined_backup_path} {remote_tar_path}"
+
+            # The htdocs location is recorded so restores do not have to search the extracted tree
+            record_backup(project_name, ssh_host, backup_key, codec, file_index.find_htdocs(listing),
+                          group_id=group_id, started=started)
             logging.info("Backup details saved to database.")
 
-            cleanup_command = f"rm -rf {combined_backup_path} {remote_tar_path}"
-            ssh.exec_command(cleanup_command)
-            ssh.close()
+            file_index.save_index(project_name, ssh_host, listing, changes, hashes, backup_key)
+
+            if cleanup_command:
+                stdin, stdout, stderr = ssh.exec_command(cleanup_command)
+                stdout.channel.recv_exit_status()
+            return backup_key
 
     except Exception as e:
         logging.error(f"Error during backup: {e}")
         raise
 
 
+# Every host of a backup group runs as its own backup job, so groups share the
+# pool's global and per-host limits with single backups. Up to the group's
+# parallelism are queued at a time; each finishing member queues the next hosts.
+def queue_group_hosts(project_name, group_id, **options):
+    job_ids = []
+    for host in backup_groups.claim_hosts(group_id):
+        job_id = jobs.enqueue_job('backup', project_name, host, group_id=group_id, **options)
+        backup_groups.set_host_job(group_id, host, job_id)
+        job_ids.append(job_id)
+    return job_ids
+
+
+def backup_job(project_name, ssh_host, job_id=None, group_id=None, **options):
+    if group_id is None:
+        return perform_backup(project_name, ssh_host, job_id=job_id, **options)
+    # Per-host outcomes are recorded by backup_groups and the backups rows share the group id
+    try:
+        return backup_groups.run_member(group_id, ssh_host, lambda: perform_backup(
+            project_name, ssh_host, job_id=job_id, group_id=group_id, **options))
+    finally:
+        queue_group_hosts(project_name, group_id, **options)
+
+
+# Legacy pipeline: copy and tar on the remote host, then download and upload the archive
+def copy_backup(ssh, root_path, combined_backup_path, remote_tar_path, tar_filename, project_prefix,
+                compress_option, job_id=None):
+    jobs.set_phase(job_id, 'copy')
+    app_copy_command = f"cp -r {root_path} {combined_backup_path}/application"
+    stdin, stdout, stderr = ssh.exec_command(app_copy_command)
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"Application files copy failed: {stderr.read().decode()}")
+    logging.info("Application files copied.")
+
+    jobs.set_phase(job_id, 'tar')
+    # Named rather than `.` so members carry no `./` prefix, like the streamed archives
+    tar_command = f"tar -c {compress_option} -f {remote_tar_path} -C {combined_backup_path} mongo_backup application"
+    stdin, stdout, stderr = ssh.exec_command(tar_command)
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"Tar command failed: {stderr.read().decode()}")
+    logging.info(f"Backup archive created: {remote_tar_path}")
+
+    jobs.set_phase(job_id, 'transfer')
+    staging_dir = job_staging_dir(job_id)
+    os.makedirs(staging_dir, exist_ok=True)
+    local_tar_path = os.path.join(staging_dir, tar_filename)
+    transferred = [0]
+
+    def on_transfer(done, total):
+        jobs.add_bytes(job_id, done - transferred[0])
+        transferred[0] = done
+
+    try:
+        # Only a complete download is renamed into place and picked up by a resumed job
+        with ssh.open_sftp() as sftp:
+            sftp.get(remote_tar_path, f"{local_tar_path}.part", callback=on_transfer)
+        os.rename(f"{local_tar_path}.part", local_tar_path)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    upload_staged_archive(local_tar_path, project_prefix, job_id)
+
+
+# Archives are staged per job so a job resumed after a restart finds the archive
+# its interrupted run downloaded. The directory is removed once the upload
+# succeeds or fails for good; only a killed process leaves it behind.
+def job_staging_dir(job_id):
+    os.makedirs(BACKUP_STAGING_DIR, exist_ok=True)
+    if job_id is None:
+        return tempfile.mkdtemp(prefix='adhoc-', dir=BACKUP_STAGING_DIR)
+    return os.path.join(BACKUP_STAGING_DIR, f"job-{job_id}")
+
+
+def staged_archive(job_id):
+    staging_dir = os.path.join(BACKUP_STAGING_DIR, f"job-{job_id}")
+    if job_id is None or not os.path.isdir(staging_dir):
+        return None
+    names = [name for name in os.listdir(staging_dir) if not name.endswith('.part')]
+    return os.path.join(staging_dir, names[0]) if names else None
+
+
+def upload_staged_archive(local_tar_path, project_prefix, job_id=None):
+    jobs.set_phase(job_id, 'upload')
+    try:
+        upload_to_s3(local_tar_path, os.path.basename(local_tar_path), project_prefix,
+                     callback=lambda count: jobs.add_bytes(job_id, count))
+    finally:
+        shutil.rmtree(os.path.dirname(local_tar_path), ignore_errors=True)
+
+
+# Staging directories of jobs that will not run again, left by a killed process
+def cleanup_staging():
+    if not os.path.isdir(BACKUP_STAGING_DIR):
+        return
+    for name in os.listdir(BACKUP_STAGING_DIR):
+        job = jobs.get_job(int(name[len('job-'):])) if re.fullmatch(r'job-\d+', name) else None
+        if not job or job['status'] not in ('queued', 'running'):
+            shutil.rmtree(os.path.join(BACKUP_STAGING_DIR, name), ignore_errors=True)
+
+
+# Streaming pipeline: tar stdout is read over the SSH channel and uploaded to S3 as
+# multipart parts, so the archive never touches disk on either machine. The
+# application tree is renamed to `application/` inside the archive, matching the
+# layout the restore expects from the legacy pipeline.
+# With names_from_stdin, the application entries are not recursed into and are read
+# as a NUL-separated list of paths (relative to the root's parent) from stdin
+def archive_tar_command(root_path, combined_backup_path, compress_option, names_from_stdin=False):
+    # Without a staging dir the archive holds only the application files
+    root_parent, root_name = os.path.split(root_path.rstrip('/'))
+    names = "--no-recursion --null -T -" if names_from_stdin else root_name
+    staged = f"-C {combined_backup_path} mongo_backup " if combined_backup_path else ""
+    return (f"tar -c {compress_option} {staged}"
+            f"-C {root_parent} --transform 's,^{root_name}\\(/\\|$\\),application\\1,' {names}")
+
+
+def stream_command_to_s3(ssh, command, key, job_id=None):
+    stdin, stdout, stderr = ssh.exec_command(command)
+    stdin.close()
+
+    def verify():
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError(f"Command failed: {command.split()[0]}: {stderr.read().decode()}")
+
+    streaming.stream_to_s3(s3_client, stdout, BUCKET_NAME, key,
+                           callback=lambda count: jobs.add_bytes(job_id, count), verify=verify)
+    return key
+
+
+# Pipelined backup: `mongodump --archive --gzip` and the file tar run at the same
+# time on separate SSH channels, each streamed into its own S3 object. The dump
+# is stored next to the archive under catalog.DB_ARCHIVE_SUFFIX.
+def stream_backup(ssh, root_path, backup_key, compress_option, job_id=None):
+    jobs.set_phase(job_id, 'upload')
+    db_archive_key = f"{backup_key}{catalog.DB_ARCHIVE_SUFFIX}"
+    commands = {
+        db_archive_key: f"mongodump --db {MONGO_DB_NAME} --archive --gzip",
+        backup_key: archive_tar_command(root_path, None, compress_option),
+    }
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = [executor.submit(stream_command_to_s3, ssh, command, key, job_id)
+                   for key, command in commands.items()]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        # Do not leave half a backup behind
+        for future in futures:
+            if not future.exception():
+                s3_client.delete_object(Bucket=BUCKET_NAME, Key=future.result())
+        raise errors[0]
+    logging.info(f"Database dump and application archive streamed to S3: {backup_key}")
+
+
+# Incremental pipeline: the application files are streamed over SSH (lightly
+# gzipped for the wire), split into content-defined chunks locally, and only
+# chunks missing from the chunk store are uploaded. The backup itself is a
+# manifest mapping each file to its chunk hashes. Files whose size, mtime and
+# inode match the previous manifest are not read at all; their entries are
+# carried over. The database dump changes on every run, so rather than being
+# chunked it is streamed next to the manifest as in the pipelined backup.
+def incremental_backup(ssh, root_path, project_name, ssh_host, backup_key, listing, job_id=None):
+    jobs.set_phase(job_id, 'upload')
+    db_archive_key = f"{backup_key}{catalog.DB_ARCHIVE_SUFFIX}"
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        dump = executor.submit(stream_command_to_s3, ssh, f"mongodump --db {MONGO_DB_NAME} --archive --gzip",
+                               db_archive_key, job_id)
+        try:
+            hashes = chunk_application(ssh, root_path, project_name, ssh_host, backup_key, listing, job_id)
+        except Exception:
+            if not dump.exception():
+                s3_client.delete_object(Bucket=BUCKET_NAME, Key=db_archive_key)
+            raise
+    if dump.exception():
+        # Do not leave a manifest without its database dump
+        s3_client.delete_object(Bucket=BUCKET_NAME, Key=backup_key)
+        raise dump.exception()
+    return hashes
+
+
+def chunk_application(ssh, root_path, project_name, ssh_host, backup_key, listing, job_id=None):
+    root_name = os.path.basename(root_path.rstrip('/'))
+
+    previous = load_previous_manifest(project_name, ssh_host)
+    reusable = {}
+    if previous and previous.get('root_path') == root_path:
+        reusable = {entry['path']: entry for entry in previous['entries'] if entry['type'] == 'file'}
+
+    names = [root_name]
+    reused = []
+    for rel, stat in listing.items():
+        entry = reusable.get(f"application/{rel}")
+        if stat[0] == 'f' and entry and entry.get('stat') == list(stat[1:]):
+            reused.append(entry)
+        else:
+            names.append(f"{root_name}/{rel}")
+
+    tar_command = archive_tar_command(root_path, None, "--use-compress-program='gzip -1'", names_from_stdin=True)
+    stdin, stdout, stderr = ssh.exec_command(tar_command)
+
+    # Feed the name list from a thread so tar output is drained while it is written
+    def write_names():
+        try:
+            stdin.write(b''.join(name.encode(errors='surrogateescape') + b'\0' for name in names))
+        finally:
+            stdin.channel.shutdown_write()
+
+    writer = threading.Thread(target=write_names, daemon=True)
+    writer.start()
+    entries, stats = chunk_store.store_tar_stream(s3_client, BUCKET_NAME, stdout,
+                                                  callback=lambda count: jobs.add_bytes(job_id, count))
+    writer.join()
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"Tar command failed: {stderr.read().decode()}")
+
+    for entry in entries:
+        stat = listing.get(entry['path'][len('application/'):]) if entry['path'].startswith('application/') else None
+        if stat:
+            entry['stat'] = list(stat[1:])
+    streamed = {entry['path'] for entry in entries}
+    entries.extend(entry for entry in reused if entry['path'] not in streamed)
+    entries.sort(key=lambda entry: entry['path'])
+    stats['reused_files'] = len(reused)
+    logging.info(f"Reused {len(reused)} unchanged files from the previous manifest")
+
+    manifest = {
+        'version': 1,
+        'project_name': project_name,
+        'root_path': root_path,
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'stats': stats,
+        'entries': entries,
+    }
+    chunk_store.write_manifest(s3_client, BUCKET_NAME, backup_key, manifest)
+    return {entry['path'][len('application/'):]: entry['sha256'] for entry in entries
+            if entry['type'] == 'file' and entry['path'].startswith('application/')}
+
+
+def load_previous_manifest(project_name, ssh_host):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT backup_path FROM backups WHERE project_name = ? AND ssh_host = ? AND codec = 'manifest' "
+                       "ORDER BY id DESC LIMIT 1", (project_name, ssh_host))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    try:
+        return chunk_store.load_manifest(s3_client, BUCKET_NAME, row[0])
+    except Exception as e:
+        logging.warning(f"Could not load previous manifest {row[0]}, taking a full incremental base: {e}")
+        return None
+
+
+jobs.register_handler('backup', backup_job, resumable=True)
+
+
+@app.route('/jobs')
+@login_required
+def list_jobs():
+    status = request.args.get('status')
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(jobs.list_jobs(status=status, limit=limit))
+
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify(job)
+
+
+@app.route('/groups/<int:group_id>')
+@login_required
+def group_status(group_id):
+    group = backup_groups.get_group(group_id)
+    if not group:
+        return jsonify({'success': False, 'message': 'Backup group not found'}), 404
+    return jsonify(group)
+
+
+@app.route('/catalog/<project>')
+@login_required
+def catalog_backups(project):
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+    try:
+        catalog.refresh(s3_client, BUCKET_NAME, PREFIX)
+    except ClientError as e:
+        logging.error(f"Error fetching backup list from S3: {e}")
+        return jsonify({'success': False, 'message': 'Failed to fetch backups from S3.'}), 500
+    return jsonify(catalog.list_backups(PREFIX, project, page, per_page))
+
+
+@app.route('/changes')
+@login_required
+def changes():
+    project_name = request.args.get('project_name')
+    ssh_host = request.args.get('ssh_host')
+    if not all([project_name, ssh_host]):
+        return jsonify({'success': False, 'message': 'project_name and ssh_host are required'}), 400
+
+    try:
+        with ssh_pool.connection(ssh_host, SSH_USER, SSH_KEY_PATH) as ssh:
+            result = file_index.changes_since_last_backup(ssh, project_name, ssh_host, ROOT_PATH)
+    except Exception as e:
+        logging.error(f"Error checking changes: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify({
+        'success': True,
+        'indexed': result['indexed'],
+        'counts': {kind: len(result[kind]) for kind in ('added', 'modified', 'deleted')},
+        **{kind: result[kind][:limit] for kind in ('added', 'modified', 'deleted')},
+    })
+
+
+@app.route('/ssh_pool')
+@login_required
+def ssh_pool_stats():
+    return jsonify(ssh_pool.pool_stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if METRICS_TOKEN:
+        authorized = request.headers.get('Authorization') == f"Bearer {METRICS_TOKEN}"
+    else:
+        authorized = current_user.is_authenticated
+    if not authorized:
+        return 'Unauthorized\n', 401
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+# Persisted per-run phase timings, for charting trends per project and host
+@app.route('/metrics/history')
+@login_required
+def metrics_history():
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    return jsonify(metrics.history(request.args.get('project_name'), request.args.get('ssh_host'),
+                                   request.args.get('kind'), limit))
+
 
 @app.route('/restore', methods=['GET', 'POST'])
 @login_required
 def restore():
     if request.method == 'GET':
-        # Fetch available projects and backups from S3
+        # Projects come from the cached catalog; backups are loaded per project from /catalog/<project>
         try:
-            objects = s3_client.list_objects(Bucket=BUCKET_NAME, Prefix=PREFIX).get('Contents', [])
-            if not objects:
+            catalog.refresh(s3_client, BUCKET_NAME, PREFIX, force=request.args.get('refresh') == '1')
+            projects = catalog.list_projects(PREFIX)
+            if not projects:
                 flash('No backups found in S3.', 'info')
                 return redirect(url_for('dashboard'))
-
-            # Extract projects and backups properly
-            projects = sorted(set(obj['Key'].split('/')[0] for obj in objects if '/' in obj['Key']))
-            backups = [{'Key': obj['Key'], 'Name': obj['Key'].split('/')[-1]} for obj in objects if obj['Key']]
         except ClientError as e:
             logging.error(f"Error fetching backup list from S3: {e}")
             flash('Failed to fetch backups from S3.', 'error')
             return redirect(url_for('dashboard'))
 
-        return render_template('restore.html', projects=projects, backups=backups)
+        return render_template('restore.html', projects=projects)
 
     # Handle POST request for restore
     project_name = request.form.get('project_name')
@@ -269,44 +696,388 @@ def restore():
     if not all([project_name, backup_key, ssh_host]):
         return jsonify({'success': False, 'message': 'All fields are required'}), 400
 
+    pending_snapshot = None
+    run = metrics.start_run('restore', project_name, ssh_host)
+    status = 'failed'
     try:
         # Perform pre-restoration backup
         logging.info("Initiating pre-restoration backup...")
-        perform_backup(f"pre_restore_{project_name}", ssh_host)
+        metrics.set_phase(run, 'snapshot')
+        pending_snapshot = pre_restore_snapshot(project_name, ssh_host)
+
+        codec = get_backup_codec(backup_key)
+        db_archive_key = get_db_archive_key(backup_key)
+        htdocs_path = get_htdocs_path(backup_key)
+        delta = codec == 'manifest' and DELTA_RESTORE and htdocs_path is not None
+        restore_options = mongorestore_options(parallel_collections=request.form.get('parallel_collections', type=int),
+                                               insertion_workers=request.form.get('insertion_workers', type=int))
+
+        with ssh_pool.connection(ssh_host, SSH_USER, SSH_KEY_PATH) as ssh:
+            # Steps 1-3: Get the backup tarball onto the remote server and extract it. With a
+            # recorded htdocs location only the database dump and htdocs are extracted; a
+            # delta restore extracts only the dump and writes changed files in place later.
+            metrics.set_phase(run, 'extract')
+            remote_tar_path = f"/tmp/{os.path.basename(backup_key)}"
+            wanted = (['mongo_backup/'] if not db_archive_key else []) + \
+                ([f"application/{htdocs_path}/"] if htdocs_path and not delta else [])
+            if htdocs_path and not wanted:
+                logging.info("Nothing to extract: the database has its own archive and files are restored in place")
+            elif codec == 'manifest':
+                manifest_restore(ssh, backup_key, prefixes=wanted if htdocs_path else None)
+            elif RESTORE_MODE == 'stream':
+                stream_restore(ssh, backup_key, codec,
+                               members=[f"{prefix}*" for prefix in wanted] if htdocs_path else None,
+                               callback=lambda count: metrics.add_bytes(run, count))
+            else:
+                copy_restore(ssh, backup_key, remote_tar_path, codec)
+
+            # Step 4: Restore MongoDB database. It is only dropped once the files extracted,
+            # so a bad archive leaves the database untouched. Pipelined backups keep the
+            # dump in its own object, which is streamed straight into mongorestore.
+            metrics.set_phase(run, 'restore')
+            if db_archive_key:
+                restore_db_archive(ssh, db_archive_key, restore_options, lambda count: metrics.add_bytes(run, count))
+            else:
+                mongo_restore_command = f"mongorestore --drop {restore_options} --dir=/tmp/mongo_backup"
+                stdin, stdout, stderr = ssh.exec_command(mongo_restore_command)
+                if stdout.channel.recv_exit_status() != 0:
+                    raise RuntimeError(f"MongoDB restore failed: {stderr.read().decode()}")
+            logging.info("MongoDB database restored successfully.")
+
+            metrics.set_phase(run, 'copy')
+            if delta:
+                delta_restore(ssh, backup_key, htdocs_path)
+            else:
+                restore_htdocs(ssh, htdocs_path)
+
+            # Step 6: Clean up temporary files
+            cleanup_command = f"rm -rf {remote_tar_path} /tmp/mongo_backup /tmp/application"
+            ssh.exec_command(cleanup_command)
+        logging.info("Temporary files cleaned up.")
 
-        # Local and remote paths for the backup tarball
-        local_tmp_dir = tempfile.mkdtemp()
-        local_backup_path = os.path.join(local_tmp_dir, os.path.basename(backup_key))
-        remote_tar_path = f"/tmp/{os.path.basename(backup_key)}"
+        status = 'succeeded'
+        return jsonify({'success': True, 'message': 'Restore completed successfully'})
 
-        # Step 1: Download the backup tarball from S3
-        s3_client.download_file(BUCKET_NAME, backup_key, local_backup_path)
-        logging.info(f"Backup tarball downloaded to local path: {local_backup_path}")
+    except Exception as e:
+        logging.error(f"Error during restore: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-        # Step 2: Upload the tarball to the remote server
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(ssh_host, username=SSH_USER, key_filename=SSH_KEY_PATH)
+    finally:
+        metrics.finish_run(run, status)
+        # A hardlink snapshot is uploaded once the restore no longer needs the bandwidth
+        if pending_snapshot:
+            jobs.enqueue_job('snapshot_upload', pending_snapshot.pop('project_name'), ssh_host, **pending_snapshot)
 
-        with ssh.open_sftp() as sftp:
-            sftp.put(local_backup_path, remote_tar_path)
-        logging.info(f"Backup tarball uploaded to remote server at: {remote_tar_path}")
 
-        # Step 3: Extract the tarball on the remote server
-        extract_command = f"tar -xzvf {remote_tar_path} -C /tmp"
-        stdin, stdout, stderr = ssh.exec_command(extract_command)
-        if stdout.channel.recv_exit_status() != 0:
-            raise RuntimeError(f"Extraction failed: {stderr.read().decode()}")
-        logging.info(f"Backup tarball extracted on the remote server: /tmp")
+# Selective restore: only the chosen collections are restored, with --drop
+# limited to them; the application files and other collections are untouched
+@app.route('/restore/collections', methods=['POST'])
+@login_required
+def restore_collections():
+    backup_key = request.form.get('backup_key')
+    ssh_host = request.form.get('ssh_host')
+    collections = [name for name in re.split(r'[\s,]+', request.form.get('collections', '')) if name]
 
-        # Step 4: Restore MongoDB database
-        mongo_restore_command = f"mongorestore --drop --dir=/tmp/mongo_backup"
-        stdin, stdout, stderr = ssh.exec_command(mongo_restore_command)
-        if stdout.channel.recv_exit_status() != 0:
-            raise RuntimeError(f"MongoDB restore failed: {stderr.read().decode()}")
-        logging.info("MongoDB database restored successfully.")
+    if not all([backup_key, ssh_host, collections]):
+        return jsonify({'success': False, 'message': 'backup_key, ssh_host and collections are required'}), 400
+    if not all(re.fullmatch(r'[\w.\-]+', name) for name in collections):
+        return jsonify({'success': False, 'message': 'Invalid collection name'}), 400
+
+    options = mongorestore_options(collections, request.form.get('parallel_collections', type=int),
+                                   request.form.get('insertion_workers', type=int))
+    try:
+        codec = get_backup_codec(backup_key)
+        db_archive_key = get_db_archive_key(backup_key)
+        with ssh_pool.connection(ssh_host, SSH_USER, SSH_KEY_PATH) as ssh:
+            if db_archive_key:
+                # mongorestore skips the other collections while reading the archive
+                restore_db_archive(ssh, db_archive_key, options)
+            else:
+                staging = f"/tmp/selective_restore_{datetime.now().strftime('%Y%m%d-%H%M%S%f')}"
+                stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {staging}")
+                stdout.channel.recv_exit_status()
+                try:
+                    prefixes = [f"mongo_backup/{MONGO_DB_NAME}/{name}." for name in collections]
+                    if codec == 'manifest':
+                        manifest_restore(ssh, backup_key, staging, prefixes)
+                    else:
+                        stream_restore(ssh, backup_key, codec, staging, [f"{prefix}*" for prefix in prefixes])
+                    stdin, stdout, stderr = ssh.exec_command(
+                        f"mongorestore --drop {options} --dir={staging}/mongo_backup")
+                    if stdout.channel.recv_exit_status() != 0:
+                        raise RuntimeError(f"MongoDB restore failed: {stderr.read().decode()}")
+                finally:
+                    stdin, stdout, stderr = ssh.exec_command(f"rm -rf {staging}")
+                    stdout.channel.recv_exit_status()
+        logging.info(f"Restored collections {', '.join(collections)} from {backup_key}")
+        return jsonify({'success': True, 'message': f"Restored {len(collections)} collections",
+                        'collections': collections})
+
+    except Exception as e:
+        logging.error(f"Error during selective restore: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+# MySQL restore for scheduled projects: their table dumps are loaded in parallel,
+# and naming tables restores only those
+@app.route('/restore/tables', methods=['POST'])
+@login_required
+def restore_tables():
+    project_name = request.form.get('project_name')
+    backup_key = request.form.get('backup_key')
+    tables = [name for name in re.split(r'[\s,]+', request.form.get('tables', '')) if name] or None
+
+    if not all([project_name, backup_key]):
+        return jsonify({'success': False, 'message': 'project_name and backup_key are required'}), 400
+    if tables and not all(re.fullmatch(r'[\w$\-]+', name) for name in tables):
+        return jsonify({'success': False, 'message': 'Invalid table name'}), 400
+
+    try:
+        # Imported here: the scheduler's project config is only installed alongside it
+        import backup_scheduler
+        restored = backup_scheduler.restore_project_db(project_name, backup_key, tables)
+        logging.info(f"Restored {len(restored)} tables of {project_name} from {backup_key}")
+        return jsonify({'success': True, 'message': f"Restored {len(restored)} tables", 'tables': restored})
+
+    except Exception as e:
+        logging.error(f"Error during table restore: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+def latest_backup(project_name, ssh_host):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT backup_path, codec, root_path, htdocs_path FROM backups
+                          WHERE project_name = ? AND ssh_host = ? ORDER BY id DESC LIMIT 1''', (project_name, ssh_host))
+        row = cursor.fetchone()
+    return row
+
+
+# Size and checksum come from the uploaded object; multipart uploads report a
+# checksum of their part checksums, which is still stable for verification
+def record_backup(project_name, ssh_host, backup_key, codec, htdocs_path, group_id=None, started=None):
+    size = checksum = None
+    try:
+        head = s3_client.head_object(Bucket=BUCKET_NAME, Key=backup_key, ChecksumMode='ENABLED')
+        size = head['ContentLength']
+        checksum = head.get('ChecksumSHA256') or head.get('ETag', '').strip('"') or None
+    except ClientError as e:
+        logging.warning(f"Could not read size of {backup_key}: {e}")
+    duration = round(time.time() - started, 1) if started else None
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO backups (project_name, ssh_host, backup_path, root_path, timestamp, codec,
+                              group_id, htdocs_path, size, duration, checksum, status)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'completed')''',
+                       (project_name, ssh_host, backup_key, ROOT_PATH, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        codec, group_id, htdocs_path, size, duration, checksum))
+        conn.commit()
 
-        # Step 5: Locate the correct `htdocs` directory
+
+def last_backup_duration(project_name):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT duration FROM jobs WHERE kind = 'backup' AND project_name = ? AND status = 'succeeded'
+                          ORDER BY id DESC LIMIT 1''', (project_name,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Safety snapshot taken before a restore overwrites the server:
+# - 'reuse': the files have not changed since the latest backup, so that backup
+#   is copied server-side in S3 and only a fresh database dump is streamed next to it
+# - 'hardlink': the tree is hardlinked next to ROOT_PATH (restores replace files,
+#   so the links keep the old contents) and the database dumped beside it; the
+#   upload runs as a job after the restore. Returns that job's parameters.
+# - 'full': a regular backup, as before
+def pre_restore_snapshot(project_name, ssh_host):
+    started = datetime.now()
+    snapshot_project = f"pre_restore_{project_name}".replace(" ", "_")
+    timestamp = started.strftime('%Y%m%d-%H%M%S')
+    strategy, pending = 'full', None
+
+    if PRE_RESTORE_SNAPSHOT == 'smart':
+        latest = latest_backup(project_name, ssh_host)
+        with ssh_pool.connection(ssh_host, SSH_USER, SSH_KEY_PATH) as ssh:
+            changes = None
+            if latest and latest[2] == ROOT_PATH:
+                changes = file_index.changes_since_last_backup(ssh, project_name, ssh_host, ROOT_PATH)
+            if changes and changes['indexed'] and not any(changes[kind] for kind in ('added', 'modified', 'deleted')):
+                strategy = 'reuse'
+                backup_key, codec, _, htdocs_path = latest
+                extension = chunk_store.MANIFEST_EXTENSION if codec == 'manifest' else \
+                    compression.archive_extension(codec or compression.codec_for_key(backup_key))
+                snapshot_key = f"{PREFIX}{snapshot_project}/{snapshot_project}-backup-{timestamp}{extension}"
+                s3_client.copy({'Bucket': BUCKET_NAME, 'Key': backup_key}, BUCKET_NAME, snapshot_key)
+                stream_command_to_s3(ssh, f"mongodump --db {MONGO_DB_NAME} --archive --gzip",
+                                     f"{snapshot_key}{catalog.DB_ARCHIVE_SUFFIX}")
+                record_backup(snapshot_project, ssh_host, snapshot_key, codec, htdocs_path)
+            else:
+                root_parent, root_name = os.path.split(ROOT_PATH.rstrip('/'))
+                snapshot_dir = f"{root_parent}/.{snapshot_project}_{timestamp}"
+                stdin, stdout, stderr = ssh.exec_command(
+                    f"mkdir -p {snapshot_dir} && cp -al {ROOT_PATH} {snapshot_dir}/{root_name} && "
+                    f"mongodump --db {MONGO_DB_NAME} --archive={snapshot_dir}/mongo.archive.gz --gzip")
+                if stdout.channel.recv_exit_status() == 0:
+                    strategy = 'hardlink'
+                    pending = {'project_name': snapshot_project, 'snapshot_dir': snapshot_dir, 'timestamp': timestamp}
+                else:
+                    logging.warning(f"Hardlink snapshot failed, taking a full backup: {stderr.read().decode()}")
+                    ssh.exec_command(f"rm -rf {snapshot_dir}")
+
+    if strategy == 'full':
+        perform_backup(snapshot_project, ssh_host)
+
+    elapsed = (datetime.now() - started).total_seconds()
+    baseline = last_backup_duration(project_name)
+    saved = f", about {baseline - elapsed:.1f}s saved against the last full backup" if baseline else ""
+    logging.info(f"Pre-restore snapshot for {project_name} on {ssh_host}: {strategy} in {elapsed:.1f}s{saved}")
+    return pending
+
+
+# Upload a hardlink snapshot left by pre_restore_snapshot as a pipelined backup.
+# The snapshot is only removed once uploaded, so a failed job leaves it on the server.
+def upload_snapshot(project_name, ssh_host, job_id=None, snapshot_dir=None, timestamp=None):
+    codec = compression.COMPRESSION_CODEC
+    backup_key = (f"{PREFIX}{project_name}/{project_name}-backup-{timestamp}"
+                  f"{compression.archive_extension(codec)}")
+    snapshot_root = f"{snapshot_dir}/{os.path.basename(ROOT_PATH.rstrip('/'))}"
+    with ssh_pool.connection(ssh_host, SSH_USER, SSH_KEY_PATH) as ssh:
+        jobs.set_phase(job_id, 'scan')
+        htdocs_path = file_index.find_htdocs(file_index.scan_remote(ssh, snapshot_root))
+        jobs.set_phase(job_id, 'upload')
+        stream_command_to_s3(ssh, f"cat {snapshot_dir}/mongo.archive.gz",
+                             f"{backup_key}{catalog.DB_ARCHIVE_SUFFIX}", job_id)
+        stream_command_to_s3(ssh, archive_tar_command(snapshot_root, None, compression.tar_compress_option(codec)),
+                             backup_key, job_id)
+        record_backup(project_name, ssh_host, backup_key, codec, htdocs_path)
+        stdin, stdout, stderr = ssh.exec_command(f"rm -rf {snapshot_dir}")
+        stdout.channel.recv_exit_status()
+    logging.info(f"Pre-restore snapshot uploaded: {backup_key}")
+
+
+jobs.register_handler('snapshot_upload', upload_snapshot, resumable=True)
+
+
+def get_backup_codec(backup_key):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT codec FROM backups WHERE backup_path = ?", (backup_key,))
+        row = cursor.fetchone()
+    if row and row[0]:
+        return row[0]
+    if backup_key.endswith(chunk_store.MANIFEST_EXTENSION):
+        return 'manifest'
+    return compression.codec_for_key(backup_key)
+
+
+def get_htdocs_path(backup_key):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT htdocs_path FROM backups WHERE backup_path = ?", (backup_key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_db_archive_key(backup_key):
+    db_archive_key = f"{backup_key}{catalog.DB_ARCHIVE_SUFFIX}"
+    try:
+        s3_client.head_object(Bucket=BUCKET_NAME, Key=db_archive_key)
+    except ClientError:
+        return None
+    return db_archive_key
+
+
+def mongorestore_options(collections=None, parallel_collections=None, insertion_workers=None):
+    options = (f"--numParallelCollections {parallel_collections or MONGORESTORE_PARALLEL_COLLECTIONS} "
+               f"--numInsertionWorkersPerCollection {insertion_workers or MONGORESTORE_INSERTION_WORKERS}")
+    # With --nsInclude, --drop only drops the collections being restored
+    for collection in collections or []:
+        options += f" --nsInclude {MONGO_DB_NAME}.{collection}"
+    return options
+
+
+# The dump object is streamed straight into `mongorestore --archive`
+def restore_db_archive(ssh, db_archive_key, options='', callback=None):
+    stdin, stdout, stderr = ssh.exec_command(f"mongorestore --drop {options} --archive --gzip")
+    try:
+        streaming.stream_from_s3(s3_client, BUCKET_NAME, db_archive_key, stdin, callback=callback)
+    finally:
+        stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"MongoDB restore failed: {stderr.read().decode()}")
+
+
+# Legacy restore: download the tarball, upload it to the server over SFTP, then extract
+def copy_restore(ssh, backup_key, remote_tar_path, codec):
+    local_tmp_dir = tempfile.mkdtemp()
+    local_backup_path = os.path.join(local_tmp_dir, os.path.basename(backup_key))
+
+    # Step 1: Download the backup tarball from S3
+    s3_client.download_file(BUCKET_NAME, backup_key, local_backup_path)
+    logging.info(f"Backup tarball downloaded to local path: {local_backup_path}")
+
+    # Step 2: Upload the tarball to the remote server
+    with ssh.open_sftp() as sftp:
+        sftp.put(local_backup_path, remote_tar_path)
+    logging.info(f"Backup tarball uploaded to remote server at: {remote_tar_path}")
+
+    os.remove(local_backup_path)
+    os.rmdir(local_tmp_dir)
+
+    # Step 3: Extract the tarball on the remote server
+    extract_command = f"tar -xv {compression.tar_decompress_option(codec)} -f {remote_tar_path} -C /tmp"
+    stdin, stdout, stderr = ssh.exec_command(extract_command)
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"Extraction failed: {stderr.read().decode()}")
+    logging.info(f"Backup tarball extracted on the remote server: /tmp")
+
+
+# Streaming restore: ranged S3 GETs are written in order to the stdin of a remote
+# `tar -x`, so the archive is never stored on either machine
+def stream_restore(ssh, backup_key, codec, target='/tmp', members=None, callback=None):
+    # `members` are tar wildcards; everything else in the archive is skipped. They are
+    # unanchored because older and 'file'-mode archives prefix every member with `./`.
+    patterns = " --wildcards --no-anchored " + " ".join(f"'{member}'" for member in members) if members else ""
+    stdin, stdout, stderr = ssh.exec_command(
+        f"tar -x {compression.tar_decompress_option(codec)} -C {target}{patterns}")
+    try:
+        streaming.stream_from_s3(s3_client, BUCKET_NAME, backup_key, stdin, callback=callback)
+    finally:
+        stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"Extraction failed: {stderr.read().decode()}")
+    logging.info(f"Backup archive streamed and extracted on the remote server: {target}")
+
+
+# Incremental restore: the archive is rebuilt from the manifest and its chunks and
+# streamed into a remote `tar -x`
+def manifest_restore(ssh, backup_key, target='/tmp', prefixes=None):
+    # With `prefixes`, only matching entries are rebuilt, so only their chunks are fetched
+    manifest = chunk_store.load_manifest(s3_client, BUCKET_NAME, backup_key)
+    entries = None
+    if prefixes:
+        entries = [entry for entry in manifest['entries'] if entry['path'].startswith(tuple(prefixes))]
+        if not entries:
+            raise FileNotFoundError(f"Nothing matching {', '.join(prefixes)} in {backup_key}")
+    stdin, stdout, stderr = ssh.exec_command(f"tar -x -C {target}")
+    try:
+        chunk_store.write_tar_stream(s3_client, BUCKET_NAME, manifest, stdin, entries)
+    finally:
+        stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"Extraction failed: {stderr.read().decode()}")
+    logging.info(f"Backup rebuilt from manifest and extracted on the remote server: {target}")
+
+
+
+# Copy the extracted htdocs over the live one; backups taken before the location
+# was recorded fall back to searching the extracted tree
+def restore_htdocs(ssh, htdocs_path=None):
+    # Step 5: Locate the correct `htdocs` directory
+    if htdocs_path:
+        target_dir = f"/tmp/application/{htdocs_path}"
+    else:
         locate_dir_command = "find /tmp/application -type d -name 'htdocs'"
         stdin, stdout, stderr = ssh.exec_command(locate_dir_command)
         all_dirs = stdout.read().decode().strip().split("\n")
@@ -325,52 +1096,88 @@ def restore():
         if not target_dir:
             raise FileNotFoundError("Application directory (htdocs) not found in the extracted backup.")
 
-        logging.info(f"Target application directory identified: {target_dir}")
-
-        # Ensure ROOT_PATH exists
-        check_root_path_command = f"mkdir -p {ROOT_PATH}"
-        ssh.exec_command(check_root_path_command)
-
-        # Copy the application files to ROOT_PATH
-        app_restore_command = f"rsync -avz {target_dir}/ {ROOT_PATH}/htdocs"
-        stdin, stdout, stderr = ssh.exec_command(app_restore_command)
-        restore_stderr = stderr.read().decode()
-
-        if stdout.channel.recv_exit_status() != 0 or restore_stderr:
-            logging.error(f"Application files restoration failed: {restore_stderr}")
-            raise RuntimeError(f"Application files restoration failed: {restore_stderr}")
-
-        logging.info(f"Application files restored to: {ROOT_PATH}/htdocs")
-
-        # Step 6: Clean up temporary files
-        cleanup_command = f"rm -rf {remote_tar_path} /tmp/mongo_backup /tmp/application"
-        ssh.exec_command(cleanup_command)
-        ssh.close()
-
-        # Clean up local temporary folder
-        os.remove(local_backup_path)
-        os.rmdir(local_tmp_dir)
-        logging.info("Temporary files cleaned up.")
-
-        return jsonify({'success': True, 'message': 'Restore completed successfully'})
-
-    except Exception as e:
-        logging.error(f"Error during restore: {e}")
-        return jsonify({'success': False, 'message': str(e)}), 500
-
-
-
-
+    logging.info(f"Target application directory identified: {target_dir}")
+
+    # Ensure ROOT_PATH exists
+    check_root_path_command = f"mkdir -p {ROOT_PATH}"
+    stdin, stdout, stderr = ssh.exec_command(check_root_path_command)
+    stdout.channel.recv_exit_status()
+
+    # Copy the application files to ROOT_PATH
+    app_restore_command = f"rsync -avz {target_dir}/ {ROOT_PATH}/htdocs"
+    stdin, stdout, stderr = ssh.exec_command(app_restore_command)
+    restore_stderr = stderr.read().decode()
+
+    if stdout.channel.recv_exit_status() != 0 or restore_stderr:
+        logging.error(f"Application files restoration failed: {restore_stderr}")
+        raise RuntimeError(f"Application files restoration failed: {restore_stderr}")
+
+    logging.info(f"Application files restored to: {ROOT_PATH}/htdocs")
+
+
+# Delta restore: the manifest's htdocs entries are compared with the live tree.
+# Files whose size and mtime match are kept; same-size files with a different
+# mtime are hashed on the server and compared with the manifest sha256. Only
+# missing or differing entries are rebuilt from chunks and extracted in place.
+def delta_restore(ssh, backup_key, htdocs_path):
+    started = datetime.now()
+    manifest = chunk_store.load_manifest(s3_client, BUCKET_NAME, backup_key)
+    prefix = f"application/{htdocs_path}/"
+    target = f"{ROOT_PATH}/htdocs"
+    entries = [entry for entry in manifest['entries'] if entry['path'].startswith(prefix)]
+
+    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {target}")
+    stdout.channel.recv_exit_status()
+    live = file_index.scan_remote(ssh, target)
+
+    changed = set()
+    suspects = {}
+    for entry in entries:
+        rel = entry['path'][len(prefix):]
+        current = live.get(rel)
+        if entry['type'] == 'file':
+            if not current or current[0] != 'f' or current[1] != entry['size']:
+                changed.add(entry['path'])
+            elif int(current[2]) != entry['mtime']:
+                suspects[rel] = entry
+        elif entry['type'] == 'dir':
+            if not current or current[0] != 'd':
+                changed.add(entry['path'])
+        else:
+            changed.add(entry['path'])  # links are cheap to rewrite
+    if suspects:
+        live_hashes = file_index.hash_remote(ssh, target, list(suspects))
+        changed.update(entry['path'] for rel, entry in suspects.items() if live_hashes.get(rel) != entry.get('sha256'))
+
+    selected = [entry for entry in entries if entry['path'] in changed]
+    written = 0
+    if selected:
+        stdin, stdout, stderr = ssh.exec_command(f"tar -x -C {target} --strip-components={prefix.count('/')}")
+        try:
+            written = chunk_store.write_tar_stream(s3_client, BUCKET_NAME, manifest, stdin, selected)
+        finally:
+            stdin.channel.shutdown_write()
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError(f"Application files restoration failed: {stderr.read().decode()}")
 
+    logging.info(f"Delta restore of {target}: {len(selected)} of {len(entries)} entries rewritten "
+                 f"({written} bytes), {len(suspects)} files hashed, "
+                 f"{(datetime.now() - started).total_seconds():.1f}s")
 
 
-def upload_to_s3(file_path, file_name, project_prefix):
+def upload_to_s3(file_path, file_name, project_prefix, callback=None):
     try:
-        s3_client.upload_file(file_path, BUCKET_NAME, f"{project_prefix}{file_name}")
+        s3_transfer.upload_file(s3_client, file_path, BUCKET_NAME, f"{project_prefix}{file_name}", callback=callback)
         logging.info(f"Successfully uploaded {file_name} to S3")
     except ClientError as e:
+        # The backup must not be recorded as completed without its archive
         logging.error(f"Error uploading to S3: {e}")
+        raise
 
 
 if __name__ == '__main__':
+    # Only the serving process (not the debug reloader parent) picks up leftover jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        jobs.recover_jobs()
+        cleanup_staging()
     app.run(debug=True)
@@ -0,0 +1,156 @@
+# backup_groups.py
+
+import os
+import re
+import time
+import logging
+import threading
+from datetime import datetime
+import db
+
+# How many hosts of a group are queued at once; 0 means all of them, so the
+# group takes about as long as its slowest host. Each host runs as its own backup
+# job, so JOB_WORKERS and the per-host limits still apply on top of this.
+BACKUP_GROUP_PARALLELISM = int(os.getenv('BACKUP_GROUP_PARALLELISM', '0'))
+
+# Serializes claiming hosts and counting outcomes across the group's job threads
+_lock = threading.Lock()
+
+
+def init_group_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS backup_groups (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_name TEXT NOT NULL,
+                        hosts INTEGER NOT NULL,
+                        parallelism INTEGER NOT NULL,
+                        status TEXT NOT NULL,
+                        succeeded INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        created_at TEXT NOT NULL,
+                        finished_at TEXT,
+                        duration REAL
+                    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS backup_group_hosts (
+                        group_id INTEGER NOT NULL,
+                        ssh_host TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        backup_path TEXT,
+                        error TEXT,
+                        started_at TEXT,
+                        finished_at TEXT,
+                        duration REAL,
+                        PRIMARY KEY (group_id, ssh_host)
+                    )''')
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def parse_hosts(value):
+    # "10.0.0.5, 10.0.0.6\n10.0.0.7" -> unique hosts in the order given
+    hosts = []
+    for host in re.split(r'[\s,;]+', value or ''):
+        if host and host not in hosts:
+            hosts.append(host)
+    return hosts
+
+
+def create_group(project_name, hosts, parallelism=None):
+    parallelism = min(parallelism or BACKUP_GROUP_PARALLELISM or len(hosts), len(hosts))
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO backup_groups (project_name, hosts, parallelism, status, created_at)
+                          VALUES (?, ?, ?, 'queued', ?)''', (project_name, len(hosts), parallelism, _now()))
+        group_id = cursor.lastrowid
+        # Hosts stay 'pending' until claim_hosts hands them to a job
+        cursor.executemany("INSERT INTO backup_group_hosts (group_id, ssh_host, status) VALUES (?, ?, 'pending')",
+                           [(group_id, host) for host in hosts])
+        conn.commit()
+    return group_id
+
+
+def _update(table, where, **fields):
+    columns = ', '.join(f"{name} = ?" for name in fields)
+    conditions = ' AND '.join(f"{name} = ?" for name in where)
+    with db.connect() as conn:
+        conn.execute(f"UPDATE {table} SET {columns} WHERE {conditions}", (*fields.values(), *where.values()))
+        conn.commit()
+
+
+def claim_hosts(group_id):
+    # Mark as many pending hosts queued as the group's parallelism leaves room
+    # for and return them, in the order they were given
+    with _lock:
+        with db.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT parallelism FROM backup_groups WHERE id = ?", (group_id,))
+            parallelism = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM backup_group_hosts "
+                           "WHERE group_id = ? AND status IN ('queued', 'running')", (group_id,))
+            room = parallelism - cursor.fetchone()[0]
+            cursor.execute("SELECT ssh_host FROM backup_group_hosts WHERE group_id = ? AND status = 'pending' "
+                           "ORDER BY rowid LIMIT ?", (group_id, max(room, 0)))
+            hosts = [row[0] for row in cursor.fetchall()]
+            cursor.executemany("UPDATE backup_group_hosts SET status = 'queued' WHERE group_id = ? AND ssh_host = ?",
+                               [(group_id, host) for host in hosts])
+            conn.commit()
+    return hosts
+
+
+def set_host_job(group_id, ssh_host, job_id):
+    _update('backup_group_hosts', {'group_id': group_id, 'ssh_host': ssh_host}, job_id=job_id)
+
+
+def run_member(group_id, ssh_host, backup):
+    # Run one host's backup() and record its outcome; the last host of the group
+    # to finish sets the group's overall status
+    started = time.time()
+    _update('backup_group_hosts', {'group_id': group_id, 'ssh_host': ssh_host}, status='running', started_at=_now())
+    with db.connect() as conn:
+        conn.execute("UPDATE backup_groups SET status = 'running' WHERE id = ? AND status = 'queued'", (group_id,))
+        conn.commit()
+    try:
+        backup_path = backup()
+    except Exception as e:
+        logging.error(f"Group {group_id}: backup of {ssh_host} failed: {e}")
+        _finish_host(group_id, ssh_host, started, 'failed', error=str(e))
+        raise
+    logging.info(f"Group {group_id}: backup of {ssh_host} finished in {time.time() - started:.1f}s")
+    _finish_host(group_id, ssh_host, started, 'succeeded', backup_path=backup_path)
+    return backup_path
+
+
+def _finish_host(group_id, ssh_host, started, status, **fields):
+    with _lock:
+        with db.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"UPDATE backup_group_hosts SET status = ?, finished_at = ?, duration = ?"
+                           f"{''.join(f', {name} = ?' for name in fields)} WHERE group_id = ? AND ssh_host = ?",
+                           (status, _now(), round(time.time() - started, 1), *fields.values(), group_id, ssh_host))
+            cursor.execute("SELECT COUNT(*), SUM(status = 'succeeded'), SUM(status = 'failed'), MIN(started_at) "
+                           "FROM backup_group_hosts WHERE group_id = ?", (group_id,))
+            hosts, succeeded, failed, first_started = cursor.fetchone()
+            cursor.execute("UPDATE backup_groups SET succeeded = ?, failed = ? WHERE id = ?",
+                           (succeeded, failed, group_id))
+            if succeeded + failed == hosts:
+                group_status = 'succeeded' if not failed else 'partial' if succeeded else 'failed'
+                duration = (datetime.now() - datetime.strptime(first_started, '%Y-%m-%d %H:%M:%S')).total_seconds()
+                cursor.execute("UPDATE backup_groups SET status = ?, finished_at = ?, duration = ? WHERE id = ?",
+                               (group_status, _now(), round(duration, 1), group_id))
+                logging.info(f"Group {group_id} finished in {duration:.1f}s: {succeeded} succeeded, {failed} failed")
+            conn.commit()
+
+
+def get_group(group_id):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM backup_groups WHERE id = ?", (group_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        group = {column[0]: value for column, value in zip(cursor.description, row)}
+        cursor.execute("SELECT * FROM backup_group_hosts WHERE group_id = ? ORDER BY rowid", (group_id,))
+        group['results'] = [{column[0]: value for column, value in zip(cursor.description, host)}
+                            for host in cursor.fetchall()]
+    return group
@@ -1,8 +1,11 @@
 # backup_scheduler.py
 
+import io
 import os
+import re
 import subprocess
 import zipfile
+import tarfile
 import boto3
 from datetime import datetime
 import schedule
@@ -11,9 +14,23 @@ import threading
 import tempfile
 import json
 import logging
+import random
+import zlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from dotenv import load_dotenv
 from botocore.exceptions import ClientError
-from backup_utils import perform_backup, load_projects, save_projects
+from backup_utils import load_projects, save_projects
+import db
+import compression
+import retention
+import catalog
+import jobs
+import s3_transfer
+import metrics
+import streaming
+import zip_stream
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,6 +43,27 @@ AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 PREFIX = os.getenv('PREFIX')
+RETENTION_INTERVAL_MINUTES = int(os.getenv('RETENTION_INTERVAL_MINUTES', '60'))
+
+# Scheduler configuration. Each project's run is offset by a stable stagger
+# (derived from its name) plus a random jitter so jobs sharing a backup_time
+# do not all start in the same second. Global and per-host concurrency come
+# from the job pool settings (JOB_WORKERS, JOB_WORKERS_PER_HOST, JOB_HOST_LIMITS).
+SCHEDULER_STAGGER_SECONDS = int(os.getenv('SCHEDULER_STAGGER_SECONDS', '600'))
+SCHEDULER_JITTER_SECONDS = int(os.getenv('SCHEDULER_JITTER_SECONDS', '60'))
+SCHEDULER_LOCAL_WORKERS = int(os.getenv('SCHEDULER_LOCAL_WORKERS', '2'))
+# Stream scheduled zips straight to S3 instead of building them on disk first
+SCHEDULER_STREAM_UPLOAD = os.getenv('SCHEDULER_STREAM_UPLOAD', 'false').lower() == 'true'
+# Scheduled zips are built under a per-job directory here and kept until uploaded,
+# so a job interrupted mid-upload resumes its multipart upload when re-run
+SCHEDULER_STAGING_DIR = os.getenv('SCHEDULER_STAGING_DIR', os.path.join(tempfile.gettempdir(), 'scheduler_staging'))
+
+# MySQL tables loaded at once on restore
+MYSQL_LOAD_WORKERS = int(os.getenv('MYSQL_LOAD_WORKERS', '4'))
+
+# Section headers mysqldump writes before each table's and view's statements
+DUMP_SECTION = re.compile(rb'-- (Table|Temporary view|Final view) structure for (?:table|view) `(.+)`')
+DUMP_READ_SIZE = 1024 * 1024
 
 # S3 client initialization
 s3_client = boto3.client(
@@ -35,82 +73,441 @@ s3_client = boto3.client(
 )
 
 
+def dump_db_command(db_user, db_password, db_name):
+    # One transaction for the whole database, so every table comes from the same snapshot
+    return f"mysqldump -u {db_user} -p{db_password} --single-transaction {db_name}"
+
+class _DumpSection:
+    # File-like reader over one table's part of a dump; stops at the next section
+    def __init__(self, splitter, head):
+        self.splitter = splitter
+        self.buffer = bytearray(head)
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            line = self.splitter.stream.readline()
+            if not line:
+                self.done = True
+            elif DUMP_SECTION.match(line):
+                self.splitter.pending = line
+                self.done = True
+            else:
+                self.buffer += line
+        size = len(self.buffer) if size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+class DumpSplitter:
+    # Splits a whole-database mysqldump stream into per-table dumps, yielding
+    # (table, reader) in dump order; each reader must be read before the next.
+    # The dump's header (session settings such as FOREIGN_KEY_CHECKS=0) is
+    # repeated at the top of every table so each loads on its own. A view's final
+    # definition comes after all tables, so views are held back and yielded last.
+    def __init__(self, stream):
+        self.stream = stream
+        self.header = b''
+        line = stream.readline()
+        while line and not DUMP_SECTION.match(line):
+            self.header += line
+            line = stream.readline()
+        self.pending = line or None
+
+    def __iter__(self):
+        views = {}
+        while self.pending:
+            kind, name = DUMP_SECTION.match(self.pending).groups()
+            line, self.pending = self.pending, None
+            if kind == b'Table':
+                section = _DumpSection(self, self.header + line)
+                yield name.decode(), section
+                while section.read(DUMP_READ_SIZE):
+                    pass
+            else:
+                views[name] = views.get(name, b'') + _DumpSection(self, line).read()
+        for name, body in views.items():
+            yield name.decode(), io.BytesIO(self.header + body)
+
+# One dump per table under db_backup_<timestamp>/, split from a single
+# consistent dump, so tables can be loaded in parallel and restored on their own
 def create_db_backup(backup_dir, db_user, db_password, db_name):
     timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    db_backup_filename = os.path.join(backup_dir, f"db_backup_{timestamp}.sql")
-    
+    db_backup_dir = os.path.join(backup_dir, f"db_backup_{timestamp}")
+
     try:
-        dump_command = f"mysqldump -u {db_user} -p{db_password} {db_name} > {db_backup_filename}"
-        subprocess.run(dump_command, shell=True, check=True, stderr=subprocess.DEVNULL)
-        logging.info(f"Database backup created: {db_backup_filename}")
-        return db_backup_filename
+        os.makedirs(db_backup_dir)
+        command = dump_db_command(db_user, db_password, db_name)
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        tables = 0
+        with process.stdout:
+            for table, section in DumpSplitter(process.stdout):
+                with open(os.path.join(db_backup_dir, f"{table}.sql"), 'wb') as f:
+                    shutil.copyfileobj(section, f, DUMP_READ_SIZE)
+                tables += 1
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        logging.info(f"Database backup created: {db_backup_dir} ({tables} tables)")
+        return db_backup_dir
     except subprocess.CalledProcessError as e:
         logging.error(f"Error creating DB backup: {e}")
-        if os.path.exists(db_backup_filename):
-            os.remove(db_backup_filename)
+        shutil.rmtree(db_backup_dir, ignore_errors=True)
         return None
 
-def create_backup_zip(source_dir, backup_dir, db_user, db_password, db_name):
+def db_backup_members(db_backup_dir):
+    # (path, archive name) for every table dump
+    name = os.path.basename(db_backup_dir)
+    return [(os.path.join(db_backup_dir, file), f"{name}/{file}") for file in sorted(os.listdir(db_backup_dir))]
+
+def _selected_dump(name, tables):
+    # Per-table dumps are db_backup_<timestamp>/<table>.sql; older backups hold a single db_backup_<timestamp>.sql
+    folder, _, file = name.rpartition('/')
+    if not os.path.basename(folder or file).startswith('db_backup_') or not name.endswith('.sql'):
+        return False
+    if tables is None:
+        return True
+    if not folder:
+        raise ValueError("This backup has a single-file database dump; individual tables cannot be selected")
+    return file[:-len('.sql')] in tables
+
+def extract_db_dumps(archive_path, extract_dir, tables=None):
+    # Pull only the wanted table dumps out of a backup archive. Zip members are
+    # read directly; tar archives are streamed once and other members skipped.
+    dumps = []
+
+    def save(name, source):
+        path = os.path.join(extract_dir, os.path.basename(name))
+        with open(path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        dumps.append(path)
+
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as zipf:
+            for name in zipf.namelist():
+                if _selected_dump(name, tables):
+                    with zipf.open(name) as source:
+                        save(name, source)
+        return dumps
+
+    codec = compression.codec_for_key(archive_path)
+    with open(archive_path, 'rb') as f, compression.open_decompressor(codec, f) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                if member.isfile() and _selected_dump(member.name, tables):
+                    save(member.name, tar.extractfile(member))
+    return dumps
+
+def _is_view_dump(path):
+    # The first section header after the dump's session settings tells a view from a table
+    with open(path, 'rb') as f:
+        for line in f:
+            match = DUMP_SECTION.match(line)
+            if match:
+                return match.group(1) != b'Table'
+    return False
+
+def restore_db_backup(archive_path, db_user, db_password, db_name, tables=None):
+    # Load the table dumps from a backup archive, MYSQL_LOAD_WORKERS tables at a
+    # time; with `tables`, only those tables are extracted and loaded. Views need
+    # their base tables, so they are loaded one by one after every table.
+    with tempfile.TemporaryDirectory() as extract_dir:
+        dumps = extract_db_dumps(archive_path, extract_dir, tables)
+        if not dumps:
+            raise FileNotFoundError(f"No matching database dumps in {archive_path}")
+        views = [path for path in dumps if _is_view_dump(path)]
+
+        def load_dump(path):
+            subprocess.run(f"mysql -u {db_user} -p{db_password} {db_name} < {path}",
+                           shell=True, check=True, stderr=subprocess.PIPE)
+
+        with ThreadPoolExecutor(max_workers=MYSQL_LOAD_WORKERS) as executor:
+            list(executor.map(load_dump, [path for path in dumps if path not in views]))
+        for path in views:
+            load_dump(path)
+    logging.info(f"Restored {len(dumps)} database dumps from {archive_path} into {db_name}")
+    return [os.path.basename(path)[:-len('.sql')] for path in dumps]
+
+def restore_project_db(project_name, backup_key, tables=None):
+    # Restore a scheduled project's database from one of its backups in S3,
+    # using the credentials from the project config
+    details = load_projects().get(project_name)
+    if not details:
+        raise ValueError(f"Project {project_name} is not configured for scheduled backups")
+    with tempfile.TemporaryDirectory() as download_dir:
+        archive_path = os.path.join(download_dir, os.path.basename(backup_key))
+        s3_client.download_file(BUCKET_NAME, backup_key, archive_path)
+        return restore_db_backup(archive_path, details['db_user'], details['db_password'], details['db_name'],
+                                 tables)
+
+def create_backup_zip(source_dir, backup_dir, db_user, db_password, db_name, codec='zip', level=None):
+    if codec != 'zip':
+        return create_backup_archive(source_dir, backup_dir, db_user, db_password, db_name, codec, level)
+
     timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
     zip_filename = f"backup-{timestamp}.zip"
     zip_path = os.path.join(backup_dir, zip_filename)
 
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for root, _, files in os.walk(source_dir):
-            for file in files:
-                if not file.endswith('.sql'):
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, source_dir)
-                    zipf.write(file_path, arcname)
-        logging.info(f"Added files from {source_dir} to zip")
-
-        db_backup_filename = create_db_backup(backup_dir, db_user, db_password, db_name)
-        if db_backup_filename:
-            zipf.write(db_backup_filename, os.path.basename(db_backup_filename))
-            os.remove(db_backup_filename)
-            logging.info(f"Added database backup to zip and removed temporary SQL file")
+    with open(zip_path, 'wb') as f:
+        write_backup_zip(f, source_dir, db_user, db_password, db_name, level)
 
     return zip_path
 
+# Writes the backup zip front to back into `fileobj` (a file, pipe or upload
+# stream): application files are read and compressed on a thread pool, and each
+# table's mysqldump output is piped straight into its db_backup_<timestamp>/<table>.sql
+# entry, so the dump never touches disk. A configured level switches the zip
+# from stored to deflated entries.
+def write_backup_zip(fileobj, source_dir, db_user, db_password, db_name, level=None):
+    with zip_stream.ZipStreamWriter(fileobj) as zipf:
+        count = zip_stream.add_tree(zipf, source_dir, level, skip=lambda name: name.endswith('.sql'))
+        logging.info(f"Added {count} files from {source_dir} to zip")
+        stream_db_dumps(zipf, db_user, db_password, db_name, level)
+
+def stream_db_dumps(zipf, db_user, db_password, db_name, level=None):
+    # The consistent dump is split into one zip entry per table as it is read
+    folder = f"db_backup_{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    process = subprocess.Popen(dump_db_command(db_user, db_password, db_name), shell=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    tables = size = 0
+    with process.stdout:
+        for table, section in DumpSplitter(process.stdout):
+            size += zipf.add_stream(f"{folder}/{table}.sql", section, level)
+            tables += 1
+    # A half-written dump cannot be taken out of a streamed archive, so the backup fails
+    if process.wait() != 0:
+        raise RuntimeError(f"mysqldump of {db_name} failed with exit status {process.returncode}")
+    logging.info(f"Streamed database backup into zip: {tables} tables, {size} bytes")
+
+# Streams the backup zip straight into a multipart S3 upload through a pipe,
+# with no local archive; memory stays bounded by the zip prefetch window and
+# the upload's in-flight parts
+def upload_backup_zip(source_dir, db_user, db_password, db_name, project_prefix, level=None, callback=None):
+    key = f"{project_prefix}backup-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        try:
+            with open(write_fd, 'wb') as pipe:
+                write_backup_zip(pipe, source_dir, db_user, db_password, db_name, level)
+        except Exception as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=produce, name='backup-zip', daemon=True)
+
+    def verify():
+        producer.join()
+        if errors:
+            raise errors[0]
+
+    with open(read_fd, 'rb') as pipe:
+        producer.start()
+        try:
+            streaming.stream_to_s3(s3_client, pipe, BUCKET_NAME, key, callback=callback, verify=verify)
+        finally:
+            # Closing the read end stops a producer still writing after a failed upload
+            pipe.close()
+            producer.join()
+    logging.info(f"Backup zip streamed to s3://{BUCKET_NAME}/{key}")
+    return key
+
+# Same contents as create_backup_zip, written as a tar stream through a parallel
+# gzip (block-parallel process pool) or multithreaded zstd compressor
+def create_backup_archive(source_dir, backup_dir, db_user, db_password, db_name, codec, level=None):
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    archive_filename = f"backup-{timestamp}{compression.archive_extension(codec)}"
+    archive_path = os.path.join(backup_dir, archive_filename)
+
+    with open(archive_path, 'wb') as f, compression.open_compressor(codec, f, level) as compressor:
+        with tarfile.open(fileobj=compressor, mode='w|') as tar:
+            for root, _, files in os.walk(source_dir):
+                for file in files:
+                    if not file.endswith('.sql'):
+                        file_path = os.path.join(root, file)
+                        tar.add(file_path, os.path.relpath(file_path, source_dir))
+            logging.info(f"Added files from {source_dir} to {codec} archive")
+
+            db_backup_dir = create_db_backup(backup_dir, db_user, db_password, db_name)
+            if db_backup_dir:
+                for path, arcname in db_backup_members(db_backup_dir):
+                    tar.add(path, arcname)
+                shutil.rmtree(db_backup_dir)
+                logging.info(f"Added database backup to archive and removed temporary SQL files")
+
+    return archive_path
+
 def manage_backups(project_prefix):
-    response = s3_client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=project_prefix)
-    backups = response.get('Contents', [])
+    # Apply the retention policy to a single project; the scheduled pass covers all of them
+    project_name = project_prefix[len(PREFIX or ''):].strip('/')
+    retention.run_retention(s3_client, BUCKET_NAME, PREFIX or '', policies=retention_policies(),
+                            projects=[project_name])
+
+def retention_policies():
+    # Per-project GFS policies from the project config, e.g. "retention": "daily=14,monthly=12"
+    policies = {}
+    for project_name, details in load_projects().items():
+        if details.get('retention'):
+            policies[project_name.replace(" ", "_")] = retention.parse_policy(details['retention'])
+    return policies
 
-    if len(backups) > 11:
-        backups.sort(key=lambda x: x['LastModified'])
-        oldest_backup = backups[0]['Key']
-        s3_client.delete_object(Bucket=BUCKET_NAME, Key=oldest_backup)
-        logging.info(f"Deleted oldest backup: {oldest_backup}")
+def run_retention_pass():
+    try:
+        retention.run_retention(s3_client, BUCKET_NAME, PREFIX or '', policies=retention_policies())
+    except Exception as e:
+        logging.error(f"Retention pass failed: {e}")
 
-def upload_to_s3(temp_zip_path, zip_filename, project_prefix):
+def upload_to_s3(temp_zip_path, zip_filename, project_prefix, callback=None):
     try:
-        with open(temp_zip_path, 'rb') as f:
-            s3_client.upload_fileobj(f, BUCKET_NAME, f"{project_prefix}{zip_filename}")
+        s3_transfer.upload_file(s3_client, temp_zip_path, BUCKET_NAME, f"{project_prefix}{zip_filename}",
+                                callback=callback)
         logging.info(f"Successfully uploaded {zip_filename} to S3")
     except ClientError as e:
+        # The backup must not be recorded as completed without its archive. The
+        # archive is kept: the multipart upload only resumes from the same file.
         logging.error(f"Error uploading to S3: {e}")
-    finally:
-        os.unlink(temp_zip_path)
+        raise
+    os.unlink(temp_zip_path)
+
+
 
+scheduled_jobs = {}  # project_name -> backup arguments, kept in memory only
 
+def init_scheduler_db():
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS scheduled_backups (
+                            project_name TEXT PRIMARY KEY,
+                            ssh_host TEXT NOT NULL,
+                            backup_time TEXT NOT NULL,
+                            next_run TEXT NOT NULL,
+                            last_run TEXT,
+                            last_job_id INTEGER,
+                            skipped_runs INTEGER NOT NULL DEFAULT 0
+                        )''')
+        db.init_backups_table(cursor)
+        jobs.init_jobs_table(cursor)
+        catalog.init_catalog_tables(cursor)
+        s3_transfer.init_transfer_tables(cursor)
+        metrics.init_metrics_tables(cursor)
+        db.migrate(cursor)
+        conn.commit()
 
-scheduled_jobs = {}
+    # Local backups share this machine; allow a few at once unless configured otherwise
+    jobs.HOST_LIMITS.setdefault('localhost', SCHEDULER_LOCAL_WORKERS)
+    jobs.register_handler('scheduled_backup', run_scheduled_backup, resumable=True)
 
-def schedule_backup(project_name, source_dir, db_user, db_password, db_name, backup_time):
-    # Cancel any existing job for this project
-    if project_name in scheduled_jobs:
-        schedule.cancel_job(scheduled_jobs[project_name])
+def next_run_time(project_name, backup_time, after):
+    # The first daily slot after `after`, plus the project's stagger and jitter. The
+    # offset is added only once the slot is picked: comparing the offset run time
+    # instead could land a fresh, larger jitter later on the day that just ran.
+    hour, minute = map(int, backup_time.split(':'))
+    slot = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    while slot <= after:
+        slot += timedelta(days=1)
+    offset = zlib.crc32(project_name.encode()) % max(SCHEDULER_STAGGER_SECONDS, 1)
+    offset += random.randint(0, SCHEDULER_JITTER_SECONDS)
+    return slot + timedelta(seconds=offset)
 
-    # Schedule the new backup job
-    job = schedule.every().day.at(backup_time).do(
-        perform_backup, project_name, source_dir, db_user, db_password, db_name
-    )
-    scheduled_jobs[project_name] = job
-    logging.info(f"Scheduled backup for project: {project_name} at {backup_time}")
+def schedule_backup(project_name, source_dir, db_user, db_password, db_name, backup_time, ssh_host='localhost'):
+    scheduled_jobs[project_name] = (source_dir, db_user, db_password, db_name)
 
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT backup_time, next_run FROM scheduled_backups WHERE project_name = ?", (project_name,))
+        row = cursor.fetchone()
+        if row and row[0] == backup_time:
+            # Keep the persisted next run so a run missed while the service was down still happens
+            next_run = row[1]
+        else:
+            next_run = next_run_time(project_name, backup_time, datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute('''INSERT INTO scheduled_backups (project_name, ssh_host, backup_time, next_run)
+                          VALUES (?, ?, ?, ?)
+                          ON CONFLICT(project_name) DO UPDATE SET ssh_host = excluded.ssh_host,
+                              backup_time = excluded.backup_time, next_run = excluded.next_run''',
+                       (project_name, ssh_host, backup_time, next_run))
+        conn.commit()
+    logging.info(f"Scheduled backup for project: {project_name} at {backup_time} (next run {next_run})")
+
+def run_scheduled_backup(project_name, ssh_host, job_id=None):
+    # A queued job can outlive its project's entry in the project config
+    if project_name not in scheduled_jobs:
+        raise RuntimeError(f"Project {project_name} is no longer configured for scheduled backups")
+    source_dir, db_user, db_password, db_name = scheduled_jobs[project_name]
+    project_prefix = f"{PREFIX or ''}{project_name.replace(' ', '_')}/"
+    if SCHEDULER_STREAM_UPLOAD:
+        jobs.set_phase(job_id, 'upload')
+        upload_backup_zip(source_dir, db_user, db_password, db_name, project_prefix,
+                          callback=lambda count: jobs.add_bytes(job_id, count))
+    else:
+        upload_staged_zip(source_dir, db_user, db_password, db_name, project_prefix, job_id)
+    manage_backups(project_prefix)
+
+def upload_staged_zip(source_dir, db_user, db_password, db_name, project_prefix, job_id=None):
+    # A re-run of an interrupted job uploads the zip it already built, under the same key
+    os.makedirs(SCHEDULER_STAGING_DIR, exist_ok=True)
+    if job_id is None:
+        staging_dir = tempfile.mkdtemp(prefix='adhoc-', dir=SCHEDULER_STAGING_DIR)
+    else:
+        staging_dir = os.path.join(SCHEDULER_STAGING_DIR, f"job-{job_id}")
+    building_dir = os.path.join(staging_dir, 'building')
+    staged = [name for name in os.listdir(staging_dir) if name.endswith('.zip')] \
+        if os.path.isdir(staging_dir) else []
+    if staged:
+        zip_path = os.path.join(staging_dir, staged[0])
+        logging.info(f"Resuming upload of staged archive {zip_path}")
+    else:
+        # Built aside and moved in once complete, so a half-written zip is never uploaded
+        shutil.rmtree(building_dir, ignore_errors=True)
+        os.makedirs(building_dir)
+        jobs.set_phase(job_id, 'archive')
+        built = create_backup_zip(source_dir, building_dir, db_user, db_password, db_name)
+        zip_path = os.path.join(staging_dir, os.path.basename(built))
+        os.replace(built, zip_path)
+    jobs.set_phase(job_id, 'upload')
+    upload_to_s3(zip_path, os.path.basename(zip_path), project_prefix,
+                 callback=lambda count: jobs.add_bytes(job_id, count))
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+# Staging directories of jobs that will not run again; a failed job's archive is
+# kept until then
+def cleanup_staging():
+    if not os.path.isdir(SCHEDULER_STAGING_DIR):
+        return
+    for name in os.listdir(SCHEDULER_STAGING_DIR):
+        job = jobs.get_job(int(name[len('job-'):])) if re.fullmatch(r'job-\d+', name) else None
+        if not job or job['status'] not in ('queued', 'running'):
+            shutil.rmtree(os.path.join(SCHEDULER_STAGING_DIR, name), ignore_errors=True)
+
+def dispatch_due_backups(now=None):
+    # Hand every due project to the job pool. Overdue runs are coalesced into one,
+    # and a project whose previous run is still queued or running is skipped.
+    now = now or datetime.now()
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT project_name, ssh_host, backup_time FROM scheduled_backups WHERE next_run <= ?",
+                       (now.strftime('%Y-%m-%d %H:%M:%S'),))
+        for project_name, ssh_host, backup_time in cursor.fetchall():
+            if project_name not in scheduled_jobs:
+                continue
+            next_run = next_run_time(project_name, backup_time, now).strftime('%Y-%m-%d %H:%M:%S')
+            if jobs.has_active_job('scheduled_backup', project_name):
+                logging.warning(f"Skipping scheduled backup for {project_name}: previous run still in progress")
+                cursor.execute("UPDATE scheduled_backups SET next_run = ?, skipped_runs = skipped_runs + 1 "
+                               "WHERE project_name = ?", (next_run, project_name))
+                continue
+            job_id = jobs.enqueue_job('scheduled_backup', project_name, ssh_host)
+            cursor.execute("UPDATE scheduled_backups SET next_run = ?, last_run = ?, last_job_id = ? "
+                           "WHERE project_name = ?",
+                           (next_run, now.strftime('%Y-%m-%d %H:%M:%S'), job_id, project_name))
+            conn.commit()
+        conn.commit()
 
 def run_scheduler():
     while True:
+        try:
+            dispatch_due_backups()
+        except Exception as e:
+            logging.error(f"Error dispatching scheduled backups: {e}")
         schedule.run_pending()
         time.sleep(1)
 
@@ -125,12 +522,22 @@ def initialize_scheduled_backups():
             details['db_user'],
             details['db_password'],
             details['db_name'],
-            details.get('backup_time', '00:00')  # Default to midnight if not specified
-
+            details.get('backup_time', '00:00'),  # Default to midnight if not specified
+            details.get('ssh_host', 'localhost')
         )
 
 if __name__ == '__main__':
+    init_scheduler_db()
     initialize_scheduled_backups()
+    # Recovered jobs run straight away, so the projects must be loaded first
+    jobs.recover_jobs()
+    cleanup_staging()
+    schedule.every().day.do(cleanup_staging)
+    # Retention runs on its own thread so a long pass never delays dispatching
+    schedule.every(RETENTION_INTERVAL_MINUTES).minutes.do(
+        lambda: threading.Thread(target=run_retention_pass, daemon=True).start())
+    schedule.every().day.do(lambda: threading.Thread(
+        target=s3_transfer.cleanup_abandoned_uploads, args=(s3_client, BUCKET_NAME, PREFIX or ''), daemon=True).start())
     scheduler_thread = threading.Thread(target=run_scheduler)
     scheduler_thread.daemon = True
     scheduler_thread.start()
@@ -0,0 +1,120 @@
+# benchmarks/datasets.py
+
+import os
+import random
+
+# Synthetic inputs: an application tree shaped like the real ones (htdocs with
+# nested directories and a long tail of small files), and database dumps served
+# by stand-in mongodump/mongorestore/mysqldump/mysql scripts placed first on PATH.
+
+BLOCK_SIZE = 64 * 1024
+WORDS = (b"public function return array string class namespace use static protected "
+         b"private $this->request->input( 'id' ) { } ; <?php echo htmlspecialchars ").split()
+
+
+def make_blocks(seed, compressibility, count=64):
+    # compressibility 0..1: share of each block that is text rather than random bytes
+    rng = random.Random(seed)
+    blocks = []
+    for _ in range(count):
+        text_size = int(BLOCK_SIZE * compressibility)
+        text = bytearray()
+        while len(text) < text_size:
+            text += rng.choice(WORDS) + b' '
+        blocks.append(bytes(text[:text_size]) + rng.randbytes(BLOCK_SIZE - text_size))
+    return blocks
+
+
+def _fill(f, size, blocks, rng):
+    while size > 0:
+        data = rng.choice(blocks)[:size]
+        f.write(data)
+        size -= len(data)
+
+
+def make_tree(root, files, total_size, seed=0, compressibility=0.5, fanout=8):
+    # `files` files totalling about `total_size` bytes under root/htdocs, with
+    # log-normally distributed sizes; returns the bytes written
+    rng = random.Random(seed)
+    blocks = make_blocks(seed, compressibility)
+    weights = [rng.lognormvariate(0, 1.5) for _ in range(files)]
+    scale = total_size / sum(weights) if weights else 0
+    written = 0
+    for i, weight in enumerate(weights):
+        depth = i % 4
+        parts = [f"d{(i // fanout ** level) % fanout}" for level in range(1, depth + 1)]
+        directory = os.path.join(root, 'htdocs', *parts)
+        os.makedirs(directory, exist_ok=True)
+        size = max(int(weight * scale), 1)
+        with open(os.path.join(directory, f"file{i}.php"), 'wb') as f:
+            _fill(f, size, blocks, rng)
+        written += size
+    return written
+
+
+def churn_tree(root, fraction, seed=1):
+    # Rewrite `fraction` of the files with new contents (same size); returns bytes changed
+    rng = random.Random(seed)
+    blocks = make_blocks(seed, 0.5, count=8)
+    paths = sorted(os.path.join(directory, name) for directory, _, names in os.walk(root) for name in names)
+    changed = 0
+    for path in rng.sample(paths, int(len(paths) * fraction)):
+        size = os.path.getsize(path)
+        with open(path, 'wb') as f:
+            _fill(f, size, blocks, rng)
+        changed += size
+    return changed
+
+
+def tree_size(root):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(root) for name in names)
+
+
+def make_db_tools(workdir, db_size, tables=8, seed=0, compressibility=0.7):
+    # Writes a dump of `db_size` bytes and stand-in database tools that serve or
+    # swallow it; returns the directory to put first on PATH
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    dump = os.path.join(workdir, 'db.dump')
+    with open(dump, 'wb') as f:
+        _fill(f, db_size, make_blocks(seed, compressibility), random.Random(seed))
+    table_size = max(db_size // tables, 1)
+    table_names = ' '.join(f"table{i}" for i in range(tables))
+
+    scripts = {
+        # --archive[=file] writes the dump; --out <dir> writes it as one collection
+        'mongodump': f'''#!/bin/bash
+out=""
+for arg; do
+  case $arg in
+    --archive=*) cat {dump} > "${{arg#--archive=}}"; exit 0;;
+    --out) next=out;;
+    *) [ "$next" = out ] && out=$arg; next="";;
+  esac
+done
+if [ -n "$out" ]; then mkdir -p "$out/db" && cat {dump} > "$out/db/collection.bson"; else cat {dump}; fi
+''',
+        'mongorestore': '''#!/bin/bash
+case "$*" in *--archive*) cat > /dev/null;; esac
+exit 0
+''',
+        # a whole-database dump with a section per table, as split by the scheduler
+        'mysqldump': f'''#!/bin/bash
+echo '/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;'
+for table in {table_names}; do
+  printf -- '--\\n-- Table structure for table `%s`\\n--\\n' "$table"
+  head -c {table_size} {dump}
+  echo
+done
+''',
+        'mysql': '''#!/bin/bash
+cat > /dev/null
+''',
+    }
+    for name, script in scripts.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    return bin_dir
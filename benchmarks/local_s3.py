@@ -0,0 +1,192 @@
+# benchmarks/local_s3.py
+
+import io
+import os
+import base64
+import shutil
+import hashlib
+import threading
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+from botocore.exceptions import ClientError
+
+# An in-process stand-in for the boto3 S3 client, covering the calls the app
+# makes. Objects are files under a directory, so stored bytes show up as disk
+# usage and memory measurements are not inflated by the store. LastModified is
+# the file mtime, which lets the retention benchmark seed months of backups.
+
+
+def _error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class _Paginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        return self.method(**kwargs)
+
+
+class LocalS3:
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.uploads = {}  # upload_id -> (key, {part_number: (path, size)}, initiated)
+        self.requests = 0
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'parts'), exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, 'objects', quote(key, safe=''))
+
+    def _count(self):
+        with self.lock:
+            self.requests += 1
+
+    def _head(self, key):
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return None
+        return stat
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._count()
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with open(self._path(Key), 'wb') as f:
+            f.write(data)
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._count()
+        if not self._head(Key):
+            raise _error('NoSuchKey', 'GetObject')
+        with open(self._path(Key), 'rb') as f:
+            if Range:
+                start, end = map(int, Range[len('bytes='):].split('-'))
+                f.seek(start)
+                data = f.read(end - start + 1)
+            else:
+                data = f.read()
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count()
+        stat = self._head(Key)
+        if not stat:
+            raise _error('404', 'HeadObject')
+        return {'ContentLength': stat.st_size, 'ETag': f'"{stat.st_ino:x}"',
+                'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self._count()
+        if not self._head(Key):
+            raise _error('404', 'HeadObject')
+        shutil.copyfile(self._path(Key), Filename)
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        self._count()
+        shutil.copyfile(self._path(CopySource['Key']), self._path(Key))
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._count()
+        if self._head(Key):
+            os.unlink(self._path(Key))
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._count()
+        for obj in Delete['Objects']:
+            if self._head(obj['Key']):
+                os.unlink(self._path(obj['Key']))
+        return {'Deleted': Delete['Objects']} if not Delete.get('Quiet') else {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._count()
+        with self.lock:
+            upload_id = f"upload-{len(self.uploads) + 1}-{os.urandom(4).hex()}"
+            self.uploads[upload_id] = (Key, {}, datetime.now(timezone.utc))
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ChecksumSHA256=None, **kwargs):
+        self._count()
+        if UploadId not in self.uploads:
+            raise _error('NoSuchUpload', 'UploadPart')
+        data = Body if isinstance(Body, bytes) else Body.read()
+        digest = base64.b64encode(hashlib.sha256(data).digest()).decode()
+        if ChecksumSHA256 and ChecksumSHA256 != digest:
+            raise _error('BadDigest', 'UploadPart')
+        path = os.path.join(self.root, 'parts', f"{UploadId}.{PartNumber}")
+        with open(path, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            self.uploads[UploadId][1][PartNumber] = (path, len(data))
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"', 'ChecksumSHA256': digest}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._count()
+        with self.lock:
+            upload = self.uploads.pop(UploadId, None)
+        if not upload:
+            raise _error('NoSuchUpload', 'CompleteMultipartUpload')
+        with open(self._path(Key), 'wb') as out:
+            for part in MultipartUpload['Parts']:
+                path = upload[1][part['PartNumber']][0]
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        for path, _ in upload[1].values():
+            os.unlink(path)
+        return {'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._count()
+        with self.lock:
+            upload = self.uploads.pop(UploadId, None)
+        for path, _ in (upload[1].values() if upload else []):
+            os.unlink(path)
+        return {}
+
+    def get_paginator(self, operation):
+        return _Paginator(getattr(self, f"_paginate_{operation}"))
+
+    def _paginate_list_objects_v2(self, Bucket, Prefix='', PageSize=1000):
+        keys = []
+        for name in os.listdir(os.path.join(self.root, 'objects')):
+            key = unquote(name)
+            if key.startswith(Prefix):
+                keys.append(key)
+        keys.sort()
+        for start in range(0, max(len(keys), 1), PageSize):
+            contents = []
+            for key in keys[start:start + PageSize]:
+                stat = os.stat(self._path(key))
+                contents.append({'Key': key, 'Size': stat.st_size,
+                                 'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)})
+            self._count()
+            yield {'Contents': contents}
+
+    def _paginate_list_parts(self, Bucket, Key, UploadId):
+        self._count()
+        if UploadId not in self.uploads:
+            raise _error('NoSuchUpload', 'ListParts')
+        yield {'Parts': [{'PartNumber': number, 'Size': size}
+                         for number, (_, size) in sorted(self.uploads[UploadId][1].items())]}
+
+    def _paginate_list_multipart_uploads(self, Bucket, Prefix=''):
+        self._count()
+        yield {'Uploads': [{'Key': key, 'UploadId': upload_id, 'Initiated': initiated}
+                           for upload_id, (key, _, initiated) in list(self.uploads.items())
+                           if key.startswith(Prefix)]}
+
+    # Benchmark helpers, not part of the boto3 API
+
+    def set_last_modified(self, key, when):
+        os.utime(self._path(key), (when.timestamp(), when.timestamp()))
+
+    def stored_bytes(self, prefix=''):
+        total = 0
+        for name in os.listdir(os.path.join(self.root, 'objects')):
+            if name.startswith(quote(prefix, safe='')):
+                total += os.path.getsize(os.path.join(self.root, 'objects', name))
+        return total
@@ -0,0 +1,115 @@
+# benchmarks/local_ssh.py
+
+import os
+import socket
+import logging
+import threading
+import subprocess
+import paramiko
+
+# A paramiko SSH server on 127.0.0.1 that runs every exec request with bash on
+# this machine, so the backup and restore pipelines talk real SSH (channels,
+# window sizes, encryption) without a remote host. Only the generated client
+# key is accepted. There is no SFTP subsystem; the 'file' modes need a real sshd.
+
+PUMP_SIZE = 32 * 1024
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, client_key):
+        self.client_key = client_key
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() == self.client_key.get_base64():
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+def _run_command(channel, command):
+    process = subprocess.Popen(['bash', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    def feed_stdin():
+        try:
+            while True:
+                data = channel.recv(PUMP_SIZE)
+                if not data:
+                    break
+                process.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            pass  # the command exited without reading all of its input
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    def pump(source, send):
+        while True:
+            data = source.read1(PUMP_SIZE)
+            if not data:
+                break
+            send(data)
+
+    pumps = [threading.Thread(target=feed_stdin, daemon=True),
+             threading.Thread(target=pump, args=(process.stdout, channel.sendall), daemon=True),
+             threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr), daemon=True)]
+    for thread in pumps:
+        thread.start()
+    for thread in pumps[1:]:
+        thread.join()
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+class LocalSSHServer:
+    def __init__(self, workdir):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key = paramiko.RSAKey.generate(2048)
+        self.key_path = os.path.join(workdir, 'client_key')
+        self.client_key.write_private_key_file(self.key_path)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self.running = True
+        threading.Thread(target=self._accept, name='bench-sshd', daemon=True).start()
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.port}"
+
+    def _accept(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            try:
+                transport.start_server(server=_Server(self.client_key))
+            except paramiko.SSHException as e:
+                logging.warning(f"Benchmark SSH handshake failed: {e}")
+                continue
+            self.transports.append(transport)
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
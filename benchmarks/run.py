@@ -0,0 +1,412 @@
+# benchmarks/run.py
+#
+# Benchmarks for the backup, restore and retention paths against local
+# stand-ins: a paramiko SSH server that runs commands on this machine, an
+# on-disk S3 fake and stand-in database tools serving a synthetic dump.
+#
+# Run from the repository root:
+#   python -m benchmarks.run                                  # defaults: 500 files, 50 MiB, 10 MiB dump
+#   python -m benchmarks.run --files 5000 --size 500 --repeat 5 -s backup-stream -s restore-stream
+#   python -m benchmarks.run --compare benchmarks/results/20260101-120000.json
+#
+# Each scenario reports latency (per run), throughput, peak RSS of this process
+# (which includes the SSH server and S3 fake, but not the tar/mongodump child
+# processes) and peak disk usage of the work directory. Results are written to
+# benchmarks/results/<timestamp>.json; --compare prints the change against an
+# earlier file and exits non-zero when a scenario got slower than --threshold.
+#
+# Restores write to /tmp/application and /tmp/mongo_backup on "the server" like
+# a real restore does, and need rsync unless the backup is incremental. The
+# 'file' backup mode needs SFTP, so it only runs against a real sshd (--ssh-host).
+
+import os
+import sys
+import json
+import time
+import shutil
+import getpass
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+import types
+from datetime import datetime, timedelta
+
+from benchmarks import datasets
+from benchmarks.local_s3 import LocalS3
+from benchmarks.local_ssh import LocalSSHServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+BUCKET = 'benchmark'
+SAMPLE_INTERVAL = 0.02
+MiB = 1024 * 1024
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Sampler(threading.Thread):
+    # Polls RSS and disk usage while an operation runs and keeps the peaks
+    def __init__(self, workdir):
+        super().__init__(daemon=True)
+        self.workdir = workdir
+        self.stopped = threading.Event()
+        self.rss_start = self.peak_rss = _rss()
+        self.disk_start = self.peak_disk = shutil.disk_usage(workdir).used
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, _rss())
+            self.peak_disk = max(self.peak_disk, shutil.disk_usage(self.workdir).used)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, _rss())
+        self.peak_disk = max(self.peak_disk, shutil.disk_usage(self.workdir).used)
+
+
+def measure(env, operation):
+    sampler = Sampler(env.workdir)
+    s3_before = env.s3.stored_bytes()
+    requests_before = env.s3.requests
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        operation()
+    finally:
+        duration = time.perf_counter() - started
+        sampler.stop()
+    return {
+        'duration': duration,
+        'peak_rss': sampler.peak_rss,
+        'rss_growth': sampler.peak_rss - sampler.rss_start,
+        'peak_disk': sampler.peak_disk - sampler.disk_start,
+        's3_bytes': env.s3.stored_bytes() - s3_before,
+        's3_requests': env.s3.requests - requests_before,
+    }
+
+
+class Environment:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='backup-bench-', dir=args.workdir)
+        self.root = os.path.join(self.workdir, 'app', 'sharklaravel')
+        self.zip_dir = os.path.join(self.workdir, 'zips')
+        os.makedirs(self.zip_dir)
+        os.environ['DB_PATH'] = os.path.join(self.workdir, 'app_config.db')
+        os.environ['PREFIX'] = 'backups/'
+
+        self.tree_bytes = datasets.make_tree(self.root, args.files, args.size * MiB, seed=args.seed,
+                                             compressibility=args.compressibility)
+        self.db_bytes = args.db_size * MiB
+        bin_dir = datasets.make_db_tools(self.workdir, self.db_bytes, tables=args.tables, seed=args.seed)
+        os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+        self.data_bytes = self.tree_bytes + self.db_bytes
+
+        self.s3 = LocalS3(os.path.join(self.workdir, 's3'))
+        self.ssh_server = None
+        if args.ssh_host:
+            self.host, self.ssh_user, self.ssh_key = args.ssh_host, args.ssh_user, args.ssh_key
+        else:
+            self.ssh_server = LocalSSHServer(self.workdir)
+            self.host, self.ssh_user, self.ssh_key = self.ssh_server.address, getpass.getuser(), \
+                self.ssh_server.key_path
+
+        # The app reads its configuration at import time, so it is imported once
+        # the environment above is in place
+        sys.path.insert(0, REPO_ROOT)
+        import app
+        import jobs
+        import retention
+        self.app, self.jobs, self.retention = app, jobs, retention
+        app.s3_client = self.s3
+        app.BUCKET_NAME = BUCKET
+        app.ROOT_PATH = self.root
+        app.SSH_USER, app.SSH_KEY_PATH = self.ssh_user, self.ssh_key
+        app.app.config['LOGIN_DISABLED'] = True
+        self.client = app.app.test_client()
+        # backup_scheduler imports backup_utils, which is not part of the
+        # repository; the benchmarked paths only need its project config
+        if 'backup_utils' not in sys.modules:
+            backup_utils = types.ModuleType('backup_utils')
+            backup_utils.perform_backup = lambda *args, **kwargs: None
+            backup_utils.load_projects = lambda: {}
+            backup_utils.save_projects = lambda projects: None
+            sys.modules['backup_utils'] = backup_utils
+        try:
+            import backup_scheduler
+            backup_scheduler.s3_client = self.s3
+            backup_scheduler.BUCKET_NAME = BUCKET
+            self.scheduler, self.scheduler_error = backup_scheduler, None
+        except ImportError as e:
+            self.scheduler, self.scheduler_error = None, str(e)
+
+    def wait_for_jobs(self):
+        # Jobs queued by a restore (snapshot uploads) must not overlap the next measurement
+        while self.jobs.list_jobs(status='queued') or self.jobs.list_jobs(status='running'):
+            time.sleep(0.05)
+
+    def close(self):
+        if self.ssh_server:
+            self.ssh_server.close()
+        if not self.args.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Skip(Exception):
+    pass
+
+
+# Scenarios: each prepares its inputs (not measured) and returns the operation
+# to time, the amount of work it does and that amount's unit
+
+def backup(mode):
+    def scenario(env, iteration):
+        if mode == 'file' and not env.args.ssh_host:
+            raise Skip("file mode needs SFTP; pass --ssh-host to use a real sshd")
+        project = f"bench-{mode}-{iteration}"
+        return (lambda: env.app.perform_backup(project, env.host, mode=mode)), env.data_bytes, 'bytes'
+    return scenario
+
+
+def backup_incremental_warm(env, iteration):
+    # A repeat incremental backup after --churn of the files changed
+    project = 'bench-incremental-warm'
+    if iteration == 0:
+        env.app.perform_backup(project, env.host, mode='incremental')
+    datasets.churn_tree(env.root, env.args.churn, seed=env.args.seed + iteration + 1)
+    return (lambda: env.app.perform_backup(project, env.host, mode='incremental')), env.data_bytes, 'bytes'
+
+
+def restore(mode):
+    def scenario(env, iteration):
+        project = f"bench-restore-{mode}"
+        if iteration == 0:
+            env.app.perform_backup(project, env.host, mode=mode)
+            env.wait_for_jobs()
+        backup_key = env.app.latest_backup(project, env.host)[0]
+
+        def operation():
+            response = env.client.post('/restore', data={'project_name': project, 'backup_key': backup_key,
+                                                         'ssh_host': env.host})
+            if response.status_code != 200:
+                raise RuntimeError(response.get_json().get('message'))
+        return operation, env.data_bytes, 'bytes'
+    return scenario
+
+
+def scheduler_archive(codec):
+    def scenario(env, iteration):
+        if not env.scheduler:
+            raise Skip(f"backup_scheduler cannot be imported: {env.scheduler_error}")
+        shutil.rmtree(env.zip_dir)
+        os.makedirs(env.zip_dir)
+        return (lambda: env.scheduler.create_backup_zip(env.root, env.zip_dir, 'bench', 'bench', 'bench',
+                                                        codec=codec)), env.data_bytes, 'bytes'
+    return scenario
+
+
+def scheduler_zip_s3(env, iteration):
+    # The scheduler's zip streamed through a pipe into a multipart upload, no local archive
+    if not env.scheduler:
+        raise Skip(f"backup_scheduler cannot be imported: {env.scheduler_error}")
+    return (lambda: env.scheduler.upload_backup_zip(env.root, 'bench', 'bench', 'bench',
+                                                    f"backups/bench-scheduler-{iteration}/")), env.data_bytes, 'bytes'
+
+
+def seed_backups(env, prefix, project_prefix='project'):
+    # --retention-backups hourly backups spread over --projects projects
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    count = env.args.retention_backups
+    for i in range(count):
+        project = f"{project_prefix}{i % env.args.projects}"
+        when = now - timedelta(hours=i // env.args.projects)
+        key = f"{prefix}{project}/{project}-backup-{when:%Y%m%d-%H%M%S}.tar.gz"
+        env.s3.put_object(Bucket=BUCKET, Key=key, Body=b'backup')
+        env.s3.set_last_modified(key, when)
+    return count
+
+
+def retention_pass(env, iteration):
+    prefix = f"retention{iteration}/"
+    count = seed_backups(env, prefix)
+    return (lambda: env.retention.run_retention(env.s3, BUCKET, prefix)), count, 'objects'
+
+
+def manage_backups(env, iteration):
+    # The scheduler's per-project retention, run after each scheduled backup,
+    # against the same backups; only the first project's are in scope
+    if not env.scheduler:
+        raise Skip(f"backup_scheduler cannot be imported: {env.scheduler_error}")
+    project_prefix = f"manage{iteration}-"
+    seed_backups(env, env.scheduler.PREFIX, project_prefix)
+    count = len(range(0, env.args.retention_backups, env.args.projects))
+    return (lambda: env.scheduler.manage_backups(f"{env.scheduler.PREFIX}{project_prefix}0/")), count, 'objects'
+
+
+SCENARIOS = {
+    'backup-stream': backup('stream'),
+    'backup-incremental': backup('incremental'),
+    'backup-file': backup('file'),
+    'backup-incremental-warm': backup_incremental_warm,
+    'restore-stream': restore('stream'),
+    'restore-incremental': restore('incremental'),
+    'scheduler-zip': scheduler_archive('zip'),
+    'scheduler-zstd': scheduler_archive('zstd'),
+    'scheduler-zip-s3': scheduler_zip_s3,
+    'retention': retention_pass,
+    'manage-backups': manage_backups,
+}
+
+
+def run_scenario(env, name, repeat):
+    runs = []
+    for iteration in range(repeat):
+        operation, amount, unit = SCENARIOS[name](env, iteration)
+        runs.append(measure(env, operation))
+        env.wait_for_jobs()
+    durations = sorted(run['duration'] for run in runs)
+    median = statistics.median(durations)
+    return {
+        'runs': len(runs),
+        'amount': amount,
+        'unit': unit,
+        'latency': {'min': durations[0], 'median': median, 'max': durations[-1],
+                    'p95': durations[min(int(len(durations) * 0.95), len(durations) - 1)]},
+        'throughput': amount / median if median else None,
+        'peak_rss': max(run['peak_rss'] for run in runs),
+        'rss_growth': max(run['rss_growth'] for run in runs),
+        'peak_disk': max(run['peak_disk'] for run in runs),
+        's3_bytes': statistics.median(run['s3_bytes'] for run in runs),
+        's3_requests': statistics.median(run['s3_requests'] for run in runs),
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_throughput(result):
+    if result.get('throughput') is None:
+        return '-'
+    if result['unit'] == 'bytes':
+        return f"{result['throughput'] / MiB:.1f} MiB/s"
+    return f"{result['throughput']:.0f} {result['unit']}/s"
+
+
+def print_report(report):
+    print(f"\n{'scenario':<26}{'median':>10}{'p95':>10}{'throughput':>16}{'peak RSS':>12}{'peak disk':>12}"
+          f"{'S3 stored':>12}")
+    for name, result in report['results'].items():
+        if 'skipped' in result or 'error' in result:
+            print(f"{name:<26}  {'skipped: ' + result['skipped'] if 'skipped' in result else 'error: ' + result['error']}")
+            continue
+        print(f"{name:<26}{result['latency']['median']:>9.2f}s{result['latency']['p95']:>9.2f}s"
+              f"{_format_throughput(result):>16}{result['peak_rss'] / MiB:>9.0f} MiB"
+              f"{result['peak_disk'] / MiB:>8.0f} MiB{result['s3_bytes'] / MiB:>8.1f} MiB")
+
+
+def compare(report, baseline, threshold):
+    # Latency and peak memory changes against an earlier report; returns the regressed scenarios
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} from {baseline.get('created_at')}:")
+    if baseline.get('params') != report['params']:
+        print("  note: the runs used different parameters, so the numbers are not directly comparable")
+    regressions = []
+    for name, result in report['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before or 'latency' not in before or 'latency' not in result:
+            continue
+        latency = result['latency']['median'] / before['latency']['median'] - 1
+        memory = result['peak_rss'] / before['peak_rss'] - 1
+        flag = ''
+        if latency > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"  {name:<26} latency {latency:+7.1%}   peak RSS {memory:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark backup, restore and retention against local stand-ins")
+    parser.add_argument('-s', '--scenario', action='append', choices=list(SCENARIOS),
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument('--files', type=int, default=500, help="files in the synthetic application tree")
+    parser.add_argument('--size', type=int, default=50, help="total size of the tree in MiB")
+    parser.add_argument('--db-size', type=int, default=10, help="size of the synthetic database dump in MiB")
+    parser.add_argument('--tables', type=int, default=8, help="tables in the synthetic MySQL database")
+    parser.add_argument('--compressibility', type=float, default=0.5, help="0 (random) .. 1 (text)")
+    parser.add_argument('--churn', type=float, default=0.05, help="share of files changed between warm backups")
+    parser.add_argument('--retention-backups', type=int, default=2000, help="backups seeded for retention")
+    parser.add_argument('--projects', type=int, default=20, help="projects the retention backups spread over")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ssh-host', help="use a real sshd (host[:port]) instead of the in-process server")
+    parser.add_argument('--ssh-user', default=getpass.getuser())
+    parser.add_argument('--ssh-key', help="private key for --ssh-host")
+    parser.add_argument('--workdir', help="parent directory for the synthetic data (default: system temp)")
+    parser.add_argument('--keep', action='store_true', help="keep the work directory afterwards")
+    parser.add_argument('--output', help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="latency increase counted as a regression")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    env = Environment(args)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    params = {name: getattr(args, name) for name in ('files', 'size', 'db_size', 'tables', 'compressibility',
+                                                      'churn', 'retention_backups', 'projects', 'repeat', 'seed')}
+    report = {
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ssh': 'sshd' if args.ssh_host else 'paramiko',
+        'params': params,
+        'data_bytes': env.data_bytes,
+        'results': {},
+    }
+    try:
+        for name in args.scenario or SCENARIOS:
+            print(f"Running {name}...", flush=True)
+            try:
+                report['results'][name] = run_scenario(env, name, args.repeat)
+            except Skip as e:
+                report['results'][name] = {'skipped': str(e)}
+            except Exception as e:
+                logging.error(f"Scenario {name} failed: {e}")
+                report['results'][name] = {'error': ' '.join(str(e).split())}
+    finally:
+        env.close()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(report, json.load(f), args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
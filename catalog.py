@@ -0,0 +1,148 @@
+# catalog.py
+
+import os
+import time
+import logging
+import threading
+import db
+
+# How long a full S3 listing is trusted before the next page load re-lists the bucket
+CATALOG_TTL = int(os.getenv('CATALOG_TTL', '300'))
+
+# Streamed backups store their database dump next to the archive as <key><suffix>;
+# these are part of that backup, not backups of their own
+DB_ARCHIVE_SUFFIX = '.mongo.archive.gz'
+
+_refresh_lock = threading.Lock()
+
+
+def init_catalog_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS catalog (
+                        key TEXT PRIMARY KEY,
+                        project TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        size INTEGER,
+                        last_modified TEXT NOT NULL,
+                        listed_at REAL NOT NULL
+                    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_catalog_project ON catalog (project, last_modified)")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS catalog_state (
+                        prefix TEXT PRIMARY KEY,
+                        refreshed_at REAL NOT NULL DEFAULT 0,
+                        last_backup_id INTEGER NOT NULL DEFAULT 0
+                    )''')
+
+
+def _split_key(key, prefix):
+    # backups/<project>/<file> -> (project, file); keys outside a project folder are skipped
+    parts = key[len(prefix):].split('/')
+    if len(parts) != 2 or not all(parts) or key.endswith(DB_ARCHIVE_SUFFIX):
+        return None
+    return parts[0], parts[1]
+
+
+def _get_state(cursor, prefix):
+    cursor.execute("INSERT OR IGNORE INTO catalog_state (prefix) VALUES (?)", (prefix,))
+    cursor.execute("SELECT refreshed_at, last_backup_id FROM catalog_state WHERE prefix = ?", (prefix,))
+    return cursor.fetchone()
+
+
+def sync_from_backups(prefix):
+    # Cheap incremental refresh: pick up rows written to `backups` since the last sync
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        _, last_backup_id = _get_state(cursor, prefix)
+        cursor.execute("SELECT id, backup_path, timestamp FROM backups WHERE id > ? ORDER BY id", (last_backup_id,))
+        rows = cursor.fetchall()
+        now = time.time()
+        for backup_id, key, timestamp in rows:
+            split = _split_key(key, prefix) if key.startswith(prefix) else None
+            if split:
+                cursor.execute('''INSERT INTO catalog (key, project, name, last_modified, listed_at)
+                                  VALUES (?, ?, ?, ?, ?)
+                                  ON CONFLICT(key) DO UPDATE SET listed_at = excluded.listed_at''',
+                               (key, split[0], split[1], timestamp, now))
+        if rows:
+            cursor.execute("UPDATE catalog_state SET last_backup_id = ? WHERE prefix = ?", (rows[-1][0], prefix))
+        conn.commit()
+
+
+def refresh_from_s3(s3_client, bucket, prefix):
+    # Full paginated listing; rows that were not seen (e.g. removed by retention) are dropped
+    started = time.time()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        count = 0
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            rows = []
+            for obj in page.get('Contents', []):
+                split = _split_key(obj['Key'], prefix)
+                if split:
+                    rows.append((obj['Key'], split[0], split[1], obj['Size'],
+                                 obj['LastModified'].astimezone().strftime('%Y-%m-%d %H:%M:%S'), time.time()))
+            cursor.executemany('''INSERT INTO catalog (key, project, name, size, last_modified, listed_at)
+                                  VALUES (?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT(key) DO UPDATE SET size = excluded.size,
+                                      last_modified = excluded.last_modified, listed_at = excluded.listed_at''', rows)
+            count += len(rows)
+        cursor.execute("DELETE FROM catalog WHERE substr(key, 1, ?) = ? AND listed_at < ?",
+                       (len(prefix), prefix, started))
+        removed = cursor.rowcount
+        _get_state(cursor, prefix)
+        cursor.execute("UPDATE catalog_state SET refreshed_at = ? WHERE prefix = ?", (started, prefix))
+        conn.commit()
+    logging.info(f"Catalog refreshed from S3: {count} backups listed, {removed} removed "
+                 f"in {time.time() - started:.1f}s")
+
+
+def refresh(s3_client, bucket, prefix, force=False):
+    sync_from_backups(prefix)
+    with db.connect() as conn:
+        refreshed_at, _ = _get_state(conn.cursor(), prefix)
+        conn.commit()
+    if not force and time.time() - refreshed_at < CATALOG_TTL:
+        return
+    # Only one request re-lists the bucket; the others serve the cached catalog.
+    # A stale (but populated) catalog is refreshed in the background.
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            refresh_from_s3(s3_client, bucket, prefix)
+        except Exception as e:
+            logging.error(f"Error refreshing backup catalog from S3: {e}")
+            if not refreshed_at:
+                raise
+        finally:
+            _refresh_lock.release()
+
+    if refreshed_at and not force:
+        threading.Thread(target=run, name='catalog-refresh', daemon=True).start()
+    else:
+        run()
+
+
+def list_projects(prefix):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT project FROM catalog WHERE substr(key, 1, ?) = ? ORDER BY project",
+                       (len(prefix), prefix))
+        projects = [row[0] for row in cursor.fetchall()]
+    return projects
+
+
+def list_backups(prefix, project, page=1, per_page=50):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM catalog WHERE substr(key, 1, ?) = ? AND project = ?",
+                       (len(prefix), prefix, project))
+        total = cursor.fetchone()[0]
+        cursor.execute('''SELECT key, name, size, last_modified FROM catalog
+                          WHERE substr(key, 1, ?) = ? AND project = ?
+                          ORDER BY last_modified DESC, key DESC LIMIT ? OFFSET ?''',
+                       (len(prefix), prefix, project, per_page, (page - 1) * per_page))
+        backups = [{'Key': key, 'Name': name, 'Size': size, 'LastModified': last_modified}
+                   for key, name, size, last_modified in cursor.fetchall()]
+    return {'project': project, 'page': page, 'per_page': per_page, 'total': total, 'backups': backups}
@@ -0,0 +1,275 @@
+# chunk_store.py
+
+import os
+import io
+import gzip
+import json
+import zlib
+import hashlib
+import logging
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import db
+
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy
+except ImportError:  # the native chunker is optional; the pure-Python gear hash is much slower
+    fastcdc_cy = None
+
+# Content-defined chunking parameters. Files smaller than the minimum chunk size
+# are stored as a single chunk.
+CHUNK_MIN_SIZE = int(os.getenv('CHUNK_MIN_SIZE', str(256 * 1024)))
+CHUNK_AVG_BITS = int(os.getenv('CHUNK_AVG_BITS', '20'))  # ~1 MiB average
+CHUNK_MAX_SIZE = int(os.getenv('CHUNK_MAX_SIZE', str(4 * 1024 * 1024)))
+CHUNK_UPLOAD_WORKERS = int(os.getenv('CHUNK_UPLOAD_WORKERS', '8'))
+CHUNK_PREFIX = os.getenv('CHUNK_PREFIX', 'chunks/')
+
+MANIFEST_EXTENSION = '.manifest.json.gz'
+
+# Gear table for the rolling hash; derived from sha256 so it is stable across runs
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+# Test the high bits of the hash, which depend on the last 32 bytes rather than the last few
+_MASK = ((1 << CHUNK_AVG_BITS) - 1) << (32 - CHUNK_AVG_BITS)
+
+
+def init_chunks_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS chunks (
+                        hash TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        stored_size INTEGER NOT NULL,
+                        created_at TEXT NOT NULL
+                    )''')
+
+
+def chunk_key(digest):
+    return f"{CHUNK_PREFIX}{digest[:2]}/{digest}"
+
+
+def find_boundary(data):
+    # Gear-hash cut point between CHUNK_MIN_SIZE and CHUNK_MAX_SIZE. The native
+    # FastCDC cuts elsewhere, so switching implementations re-uploads changed
+    # files once but never breaks existing manifests.
+    end = min(len(data), CHUNK_MAX_SIZE)
+    if end <= CHUNK_MIN_SIZE:
+        return end
+    if fastcdc_cy is not None:
+        return next(fastcdc_cy(memoryview(data)[:end], CHUNK_MIN_SIZE, 1 << CHUNK_AVG_BITS, CHUNK_MAX_SIZE,
+                               False, None)).length
+    gear = _GEAR
+    mask = _MASK
+    h = 0
+    for i in range(CHUNK_MIN_SIZE, end):
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        if not h & mask:
+            return i + 1
+    return end
+
+
+def iter_chunks(fileobj):
+    buffer = b''
+    eof = False
+    while not eof or buffer:
+        if not eof and len(buffer) < CHUNK_MAX_SIZE:
+            data = fileobj.read(CHUNK_MAX_SIZE)
+            if data:
+                buffer += data
+                continue
+            eof = True
+        if not buffer:
+            break
+        cut = find_boundary(buffer)
+        yield buffer[:cut]
+        buffer = buffer[cut:]
+
+
+class ChunkUploader:
+    # Uploads chunks that are not yet in the store on a bounded thread pool
+
+    def __init__(self, s3_client, bucket, callback=None, workers=CHUNK_UPLOAD_WORKERS):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.callback = callback
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chunk-upload')
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.futures = []
+        self.seen = set()
+        self.conn = db.connect()
+        self.lock = threading.Lock()
+        self.uploaded = []
+        self.stats = {'chunks': 0, 'new_chunks': 0, 'bytes': 0, 'new_bytes': 0}
+
+    def add(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        self.stats['chunks'] += 1
+        self.stats['bytes'] += len(data)
+        if digest in self.seen:
+            return digest
+        self.seen.add(digest)
+        # Reusing a chunk marks it used, so retention's sweep keeps it until the manifest is written
+        known = self.conn.execute("UPDATE chunks SET last_used = ? WHERE hash = ?",
+                                  (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), digest)).rowcount
+        self.conn.commit()
+        if known:
+            return digest
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._upload, digest, data))
+        return digest
+
+    def _upload(self, digest, data):
+        try:
+            body = zlib.compress(data, 6)
+            self.s3_client.put_object(Bucket=self.bucket, Key=chunk_key(digest), Body=body)
+            with self.lock:
+                self.uploaded.append((digest, len(data), len(body), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                self.stats['new_chunks'] += 1
+                self.stats['new_bytes'] += len(body)
+            if self.callback:
+                self.callback(len(body))
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.executor.shutdown()
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            # Only chunks that actually reached S3 are recorded as known
+            self.conn.executemany("INSERT OR IGNORE INTO chunks (hash, size, stored_size, created_at, last_used) "
+                                  "VALUES (?, ?, ?, ?, ?)", [(*chunk, chunk[-1]) for chunk in self.uploaded])
+            self.conn.commit()
+            self.conn.close()
+
+
+def _entry_for(member):
+    entry = {'path': member.name, 'mode': member.mode, 'mtime': member.mtime,
+             'uid': member.uid, 'gid': member.gid, 'uname': member.uname, 'gname': member.gname}
+    if member.isdir():
+        entry['type'] = 'dir'
+    elif member.issym():
+        entry.update(type='symlink', linkname=member.linkname)
+    elif member.islnk():
+        entry.update(type='hardlink', linkname=member.linkname)
+    elif member.isfile():
+        entry.update(type='file', size=member.size, chunks=[])
+    else:
+        return None  # devices, fifos and sockets are not backed up
+    return entry
+
+
+def store_tar_stream(s3_client, bucket, stream, callback=None):
+    # Read an uncompressed or gzip tar stream, upload new chunks and return the manifest entries
+    entries = []
+    uploader = ChunkUploader(s3_client, bucket, callback)
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            for member in tar:
+                entry = _entry_for(member)
+                if entry is None:
+                    continue
+                if entry['type'] == 'file':
+                    file_hash = hashlib.sha256()
+                    for chunk in iter_chunks(tar.extractfile(member)):
+                        file_hash.update(chunk)
+                        entry['chunks'].append(uploader.add(chunk))
+                    entry['sha256'] = file_hash.hexdigest()
+                entries.append(entry)
+    finally:
+        uploader.close()
+
+    stats = uploader.stats
+    logging.info(f"Chunked {stats['bytes']} bytes into {stats['chunks']} chunks; "
+                 f"uploaded {stats['new_chunks']} new chunks ({stats['new_bytes']} bytes)")
+    return entries, stats
+
+
+def write_manifest(s3_client, bucket, key, manifest):
+    body = gzip.compress(json.dumps(manifest).encode())
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+    logging.info(f"Manifest written to s3://{bucket}/{key} ({len(manifest['entries'])} entries)")
+
+
+def load_manifest(s3_client, bucket, key):
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    return json.loads(gzip.decompress(body))
+
+
+def _fetch_chunk(s3_client, bucket, digest):
+    data = zlib.decompress(s3_client.get_object(Bucket=bucket, Key=chunk_key(digest))['Body'].read())
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"Chunk {digest} failed its integrity check")
+    return data
+
+
+def iter_chunk_data(s3_client, bucket, digests, workers=CHUNK_UPLOAD_WORKERS):
+    # Yield chunk contents in order while prefetching ahead in parallel
+    digests = iter(digests)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chunk-fetch') as executor:
+        pending = deque()
+        for digest in digests:
+            pending.append(executor.submit(_fetch_chunk, s3_client, bucket, digest))
+            if len(pending) >= workers * 2:
+                break
+        try:
+            while pending:
+                yield pending.popleft().result()
+                digest = next(digests, None)
+                if digest:
+                    pending.append(executor.submit(_fetch_chunk, s3_client, bucket, digest))
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class _ChunkReader(io.RawIOBase):
+    # Reads one file's bytes from the shared in-order chunk iterator
+
+    def __init__(self, chunk_data, size):
+        self.chunk_data = chunk_data
+        self.remaining = size
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.remaining
+        while len(self.buffer) < size and self.remaining > len(self.buffer):
+            self.buffer += next(self.chunk_data)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.remaining -= len(data)
+        return data
+
+
+def write_tar_stream(s3_client, bucket, manifest, sink, entries=None, callback=None):
+    # Rebuild the archive described by a manifest as a tar stream written to `sink`
+    entries = manifest['entries'] if entries is None else entries
+    chunk_data = iter_chunk_data(s3_client, bucket,
+                                 (digest for entry in entries if entry['type'] == 'file'
+                                  for digest in entry['chunks']))
+    written = 0
+    with tarfile.open(fileobj=sink, mode='w|') as tar:
+        for entry in entries:
+            info = tarfile.TarInfo(entry['path'])
+            info.mode = entry['mode']
+            info.mtime = entry['mtime']
+            info.uid, info.gid = entry['uid'], entry['gid']
+            info.uname, info.gname = entry['uname'], entry['gname']
+            if entry['type'] == 'dir':
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif entry['type'] in ('symlink', 'hardlink'):
+                info.type = tarfile.SYMTYPE if entry['type'] == 'symlink' else tarfile.LNKTYPE
+                info.linkname = entry['linkname']
+                tar.addfile(info)
+            else:
+                info.size = entry['size']
+                tar.addfile(info, _ChunkReader(chunk_data, entry['size']))
+                written += entry['size']
+                if callback:
+                    callback(entry['size'])
+    return written
@@ -0,0 +1,127 @@
+# compression.py
+
+import os
+import gzip
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional for local archives
+    zstandard = None
+
+# Defaults used when a project does not choose its own codec/level
+COMPRESSION_CODEC = os.getenv('COMPRESSION_CODEC', 'gzip')
+COMPRESSION_LEVEL = os.getenv('COMPRESSION_LEVEL')
+COMPRESSION_THREADS = int(os.getenv('COMPRESSION_THREADS', str(os.cpu_count() or 1)))
+GZIP_BLOCK_SIZE = int(os.getenv('GZIP_BLOCK_SIZE', str(4 * 1024 * 1024)))
+
+# Remote codecs, run by tar through --use-compress-program. pigz and zstd -T0
+# use every core on the remote host; pigz produces standard gzip output, so
+# pigz archives can also be read with plain gzip. 'levels' is the range of
+# levels each compressor accepts.
+CODECS = {
+    'gzip': {'extension': '.tar.gz', 'level': 6, 'levels': (1, 9), 'compress': 'gzip -{level}',
+             'decompress': 'gzip -d'},
+    'pigz': {'extension': '.tar.gz', 'level': 6, 'levels': (1, 9), 'compress': 'pigz -{level}',
+             'decompress': 'pigz -d'},
+    'zstd': {'extension': '.tar.zst', 'level': 3, 'levels': (1, 19), 'compress': 'zstd -q -T0 -{level}',
+             'decompress': 'zstd -q -d'},
+}
+
+
+def get_codec(codec):
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+    return CODECS[codec]
+
+
+def check_level(codec, level):
+    # Reject a level the codec's compressor would fail on, before a job is queued
+    low, high = get_codec(codec)['levels']
+    if level is not None and not low <= level <= high:
+        raise ValueError(f"Compression level for {codec} must be between {low} and {high}")
+
+
+def archive_extension(codec):
+    return get_codec(codec)['extension']
+
+
+def tar_compress_option(codec, level=None):
+    spec = get_codec(codec)
+    program = spec['compress'].format(level=level or COMPRESSION_LEVEL or spec['level'])
+    return f"--use-compress-program='{program}'"
+
+
+def tar_decompress_option(codec):
+    return f"--use-compress-program='{get_codec(codec)['decompress']}'"
+
+
+# Fall back on the archive name for backups recorded before the codec column existed
+def codec_for_key(backup_key):
+    return 'zstd' if backup_key.endswith('.tar.zst') else 'gzip'
+
+
+class ParallelGzipWriter:
+    # File-like writer that compresses fixed-size blocks on a process pool and
+    # writes them in order as concatenated gzip members, which any gzip reader
+    # decodes as a single stream.
+
+    def __init__(self, fileobj, level=6, workers=COMPRESSION_THREADS, block_size=GZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = workers * 2
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(gzip.compress, block, self.level))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_compressor(codec, fileobj, level=None):
+    # Local compressors for archives built on this machine
+    spec = get_codec(codec)
+    level = int(level or COMPRESSION_LEVEL or spec['level'])
+    if codec in ('gzip', 'pigz'):
+        return ParallelGzipWriter(fileobj, level=level)
+    if zstandard is None:
+        raise RuntimeError("The zstandard package is required for local zstd compression")
+    compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+    logging.info(f"Using multithreaded zstd at level {level}")
+    return compressor.stream_writer(fileobj, closefd=False)
+
+
+def open_decompressor(codec, fileobj):
+    # Streaming readers for local archives made by open_compressor
+    get_codec(codec)
+    if codec in ('gzip', 'pigz'):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if zstandard is None:
+        raise RuntimeError("The zstandard package is required for local zstd decompression")
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
@@ -0,0 +1,124 @@
+# db.py
+
+import os
+import sqlite3
+import threading
+
+DB_PATH = os.getenv('DB_PATH', 'app_config.db')
+# Seconds a connection waits on a locked database before raising "database is locked"
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+
+_local = threading.local()
+
+# Columns and indexes added after the tables were first created. Every step is
+# idempotent and skipped while its table does not exist yet, so the web app and
+# the scheduler can both run them at startup.
+COLUMNS = {
+    'backups': [
+        ('codec', 'TEXT'),
+        ('group_id', 'INTEGER'),
+        ('htdocs_path', 'TEXT'),
+        ('size', 'INTEGER'),
+        ('duration', 'REAL'),
+        ('checksum', 'TEXT'),
+        ('status', "TEXT NOT NULL DEFAULT 'completed'"),
+    ],
+    'jobs': [
+        ('resumes', 'INTEGER NOT NULL DEFAULT 0'),
+    ],
+    'backup_group_hosts': [
+        ('job_id', 'INTEGER'),
+    ],
+    'chunks': [
+        ('last_used', 'TEXT'),
+    ],
+}
+INDEXES = {
+    'idx_backups_project': ('backups', 'project_name, ssh_host, id'),
+    'idx_backups_timestamp': ('backups', 'timestamp'),
+    'idx_backups_path': ('backups', 'backup_path'),
+    'idx_jobs_status': ('jobs', 'status, kind'),
+    'idx_jobs_project': ('jobs', 'project_name, kind, status'),
+    'idx_file_index_scans_project': ('file_index_scans', 'project_name, ssh_host'),
+    'idx_s3_transfers_key': ('s3_transfers', 'bucket, key, status'),
+    'idx_s3_transfers_upload': ('s3_transfers', 'upload_id'),
+    'idx_metric_runs_project': ('metric_runs', 'project_name, ssh_host, kind, id'),
+}
+
+
+def init_backups_table(cursor):
+    # Shared by the web app, which records backups, and the scheduler, whose
+    # retention and catalog passes read and prune them
+    cursor.execute('''CREATE TABLE IF NOT EXISTS backups (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_name TEXT NOT NULL,
+                        ssh_host TEXT NOT NULL,
+                        backup_path TEXT NOT NULL,
+                        root_path TEXT NOT NULL,
+                        timestamp TEXT NOT NULL
+                    )''')
+
+
+class PooledConnection:
+    # The calling thread's connection. close() hands it back instead of closing
+    # it; only the outermost close() rolls back anything left uncommitted. Use
+    # it as a context manager so it is handed back even when the caller raises.
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._closed = False
+        _local.depth += 1
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # A write interrupted by an exception must not keep holding the lock
+        if exc_type is not None and self._conn.in_transaction:
+            self._conn.rollback()
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        _local.depth -= 1
+        if not _local.depth and self._conn.in_transaction:
+            self._conn.rollback()
+
+
+def connect():
+    # One connection per thread, opened on first use and reused afterwards
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+        # WAL lets readers run while a job worker writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.depth = 0
+    elif not _local.depth and conn.in_transaction:
+        # Left open by a connection that was never handed back
+        conn.rollback()
+    return PooledConnection(conn)
+
+
+def add_column(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def migrate(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+    for table, columns in COLUMNS.items():
+        if table in tables:
+            for column, definition in columns:
+                add_column(cursor, table, column, definition)
+    for name, (table, columns) in INDEXES.items():
+        if table in tables:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
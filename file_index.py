@@ -0,0 +1,137 @@
+# file_index.py
+
+import logging
+import threading
+from datetime import datetime
+import db
+
+# One record per entry: type (f/d/l), path relative to the root, size, mtime, inode
+FIND_FORMAT = r"%y\0%P\0%s\0%T@\0%i\0"
+READ_SIZE = 1024 * 1024
+
+
+def init_file_index_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS file_index (
+                        project_name TEXT NOT NULL,
+                        ssh_host TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        type TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        mtime REAL NOT NULL,
+                        inode INTEGER NOT NULL,
+                        hash TEXT,
+                        PRIMARY KEY (project_name, ssh_host, path)
+                    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS file_index_scans (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_name TEXT NOT NULL,
+                        ssh_host TEXT NOT NULL,
+                        backup_path TEXT,
+                        scanned_at TEXT NOT NULL,
+                        files INTEGER NOT NULL,
+                        added INTEGER NOT NULL,
+                        modified INTEGER NOT NULL,
+                        deleted INTEGER NOT NULL
+                    )''')
+
+
+def scan_remote(ssh, root_path):
+    # Stream a single `find -printf` listing of the tree back over SSH
+    stdin, stdout, stderr = ssh.exec_command(f"find {root_path} -printf '{FIND_FORMAT}'")
+    stdin.close()
+    listing = {}
+    fields = []
+    pending = b''
+    while True:
+        data = stdout.read(READ_SIZE)
+        if not data:
+            break
+        parts = (pending + data).split(b'\0')
+        pending = parts.pop()
+        fields.extend(parts)
+        complete = len(fields) - len(fields) % 5
+        for i in range(0, complete, 5):
+            file_type, path, size, mtime, inode = fields[i:i + 5]
+            if path:  # skip the root itself
+                listing[path.decode(errors='surrogateescape')] = (
+                    file_type.decode(), int(size), float(mtime), int(inode))
+        fields = fields[complete:]
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError(f"Listing {root_path} failed: {stderr.read().decode()}")
+    logging.info(f"Scanned {len(listing)} entries under {root_path}")
+    return listing
+
+
+def find_htdocs(listing):
+    # The shallowest `htdocs` directory in a listing, relative to the scanned root
+    candidates = [path for path, entry in listing.items()
+                  if entry[0] == 'd' and path.rsplit('/', 1)[-1] == 'htdocs']
+    return min(candidates, key=lambda path: (path.count('/'), path)) if candidates else None
+
+
+def hash_remote(ssh, root_path, paths):
+    # sha256 (hex) of files under root_path, computed on the server so only the digests cross the wire
+    stdin, stdout, stderr = ssh.exec_command(f"cd {root_path} && xargs -0 -r sha256sum --")
+
+    def write_paths():
+        try:
+            stdin.write(b''.join(path.encode(errors='surrogateescape') + b'\0' for path in paths))
+        finally:
+            stdin.channel.shutdown_write()
+
+    writer = threading.Thread(target=write_paths, daemon=True)
+    writer.start()
+    output = stdout.read()
+    writer.join()
+    stdout.channel.recv_exit_status()  # unreadable files are simply missing from the result
+    hashes = {}
+    for line in output.split(b'\n'):
+        # Names with newlines or backslashes are escaped by sha256sum; leave those out
+        if line and not line.startswith(b'\\'):
+            digest, path = line.split(b'  ', 1)
+            hashes[path.decode(errors='surrogateescape')] = digest.decode()
+    return hashes
+
+
+def load_index(project_name, ssh_host):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT path, type, size, mtime, inode, hash FROM file_index "
+                       "WHERE project_name = ? AND ssh_host = ?", (project_name, ssh_host))
+        index = {row[0]: row[1:] for row in cursor.fetchall()}
+    return index
+
+
+def diff_listing(listing, index):
+    # Files whose size, mtime or inode moved are modified; directories and links
+    # only count as added or deleted
+    added = sorted(path for path in listing if path not in index)
+    deleted = sorted(path for path in index if path not in listing)
+    modified = sorted(path for path, entry in listing.items()
+                      if path in index and entry[0] == 'f' and tuple(index[path][:4]) != entry)
+    return {'added': added, 'modified': modified, 'deleted': deleted}
+
+
+def save_index(project_name, ssh_host, listing, changes, hashes=None, backup_path=None):
+    # Replace the snapshot for this project/host with the listing taken at backup time
+    hashes = hashes or {}
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM file_index WHERE project_name = ? AND ssh_host = ?", (project_name, ssh_host))
+        cursor.executemany('''INSERT INTO file_index (project_name, ssh_host, path, type, size, mtime, inode, hash)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                           ((project_name, ssh_host, path, *entry, hashes.get(path))
+                            for path, entry in listing.items()))
+        cursor.execute('''INSERT INTO file_index_scans (project_name, ssh_host, backup_path, scanned_at,
+                              files, added, modified, deleted)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (project_name, ssh_host, backup_path, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        len(listing), len(changes['added']), len(changes['modified']), len(changes['deleted'])))
+        conn.commit()
+
+
+def changes_since_last_backup(ssh, project_name, ssh_host, root_path):
+    index = load_index(project_name, ssh_host)
+    changes = diff_listing(scan_remote(ssh, root_path), index)
+    changes['indexed'] = bool(index)
+    return changes
@@ -0,0 +1,249 @@
+# jobs.py
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import db
+import metrics
+
+# Worker pool configuration
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_WORKERS_PER_HOST = int(os.getenv('JOB_WORKERS_PER_HOST', '1'))
+# Per-host overrides, e.g. "10.0.0.5=2,10.0.0.6=3"
+JOB_HOST_LIMITS = os.getenv('JOB_HOST_LIMITS', '')
+# Times a resumable job interrupted by a restart is run again before it is failed
+JOB_MAX_RESUMES = int(os.getenv('JOB_MAX_RESUMES', '2'))
+
+PHASES = ('queued', 'scan', 'dump', 'copy', 'tar', 'transfer', 'upload', 'extract', 'restore', 'done')
+
+# Registered job handlers, keyed by job kind (e.g. 'backup')
+JOB_HANDLERS = {}
+# Kinds whose handlers can safely run again after being interrupted mid-run
+RESUMABLE_KINDS = set()
+
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='backup-job')
+_pending = {}   # ssh_host -> deque of job ids waiting for a host slot
+_slots = {}     # ssh_host -> host slots taken by jobs handed to the executor
+_active = {}    # ssh_host -> number of running jobs
+_progress = {}  # job_id -> bytes moved so far (flushed to the db on phase changes)
+_runs = {}      # job_id -> metrics.Run for the running job
+
+
+def _parse_host_limits(value):
+    limits = {}
+    for item in value.split(','):
+        if '=' in item:
+            host, limit = item.split('=', 1)
+            limits[host.strip()] = int(limit)
+    return limits
+
+
+HOST_LIMITS = _parse_host_limits(JOB_HOST_LIMITS)
+
+
+def host_limit(ssh_host):
+    return HOST_LIMITS.get(ssh_host, JOB_WORKERS_PER_HOST)
+
+
+def init_jobs_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        project_name TEXT NOT NULL,
+                        ssh_host TEXT NOT NULL,
+                        params TEXT,
+                        status TEXT NOT NULL,
+                        phase TEXT NOT NULL,
+                        bytes_moved INTEGER NOT NULL DEFAULT 0,
+                        error TEXT,
+                        created_at TEXT NOT NULL,
+                        started_at TEXT,
+                        finished_at TEXT,
+                        duration REAL
+                    )''')
+
+
+def register_handler(kind, func, resumable=False):
+    JOB_HANDLERS[kind] = func
+    if resumable:
+        RESUMABLE_KINDS.add(kind)
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _update_job(job_id, **fields):
+    columns = ', '.join(f"{name} = ?" for name in fields)
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+
+
+def _row_to_dict(cursor, row):
+    job = {column[0]: value for column, value in zip(cursor.description, row)}
+    job['params'] = json.loads(job['params']) if job['params'] else {}
+    if job['status'] == 'running':
+        job['bytes_moved'] = _progress.get(job['id'], job['bytes_moved'])
+        job['duration'] = round(time.time() - datetime.strptime(
+            job['started_at'], '%Y-%m-%d %H:%M:%S').timestamp(), 1)
+    return job
+
+
+def enqueue_job(kind, project_name, ssh_host, **params):
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"No handler registered for job kind: {kind}")
+
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO jobs (kind, project_name, ssh_host, params, status, phase, created_at)
+                          VALUES (?, ?, ?, ?, 'queued', 'queued', ?)''',
+                       (kind, project_name, ssh_host, json.dumps(params), _now()))
+        job_id = cursor.lastrowid
+        conn.commit()
+
+    logging.info(f"Queued {kind} job {job_id} for project {project_name} on {ssh_host}")
+    _submit(job_id, ssh_host)
+    return job_id
+
+
+def get_job(job_id):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        row = cursor.fetchone()
+        job = _row_to_dict(cursor, row) if row else None
+    return job
+
+
+def list_jobs(status=None, limit=50):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        if status:
+            cursor.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?", (status, limit))
+        else:
+            cursor.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+        jobs = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+    return jobs
+
+
+def has_active_job(kind, project_name):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM jobs WHERE kind = ? AND project_name = ? AND status IN ('queued', 'running') "
+                       "LIMIT 1", (kind, project_name))
+        active = cursor.fetchone() is not None
+    return active
+
+
+# Progress reporting used by the job handlers; a no-op when called outside a job.
+def set_phase(job_id, phase):
+    if job_id is None:
+        return
+    _update_job(job_id, phase=phase, bytes_moved=_progress.get(job_id, 0))
+    metrics.set_phase(_runs.get(job_id), phase)
+    logging.info(f"Job {job_id} entered phase: {phase}")
+
+
+def add_bytes(job_id, count):
+    if job_id is None:
+        return
+    with _lock:
+        _progress[job_id] = _progress.get(job_id, 0) + count
+    metrics.add_bytes(_runs.get(job_id), count)
+
+
+def _submit(job_id, ssh_host):
+    with _lock:
+        _pending.setdefault(ssh_host, deque()).append(job_id)
+    _dispatch(ssh_host)
+
+
+def _dispatch(ssh_host):
+    with _lock:
+        queue = _pending.get(ssh_host)
+        while queue and _slots.get(ssh_host, 0) < host_limit(ssh_host):
+            job_id = queue.popleft()
+            _slots[ssh_host] = _slots.get(ssh_host, 0) + 1
+            _executor.submit(_run_job, job_id, ssh_host)
+
+
+def _run_job(job_id, ssh_host):
+    started = time.time()
+    status = 'failed'
+    # Only counted as active once a worker picks it up; until then it is queued
+    with _lock:
+        _active[ssh_host] = _active.get(ssh_host, 0) + 1
+    try:
+        job = get_job(job_id)
+        _update_job(job_id, status='running', started_at=_now())
+        _runs[job_id] = metrics.start_run(job['kind'], job['project_name'], ssh_host, job_id)
+        handler = JOB_HANDLERS[job['kind']]
+        handler(job['project_name'], job['ssh_host'], job_id=job_id, **job['params'])
+        status = 'succeeded'
+        _update_job(job_id, status='succeeded', phase='done', finished_at=_now(),
+                    duration=round(time.time() - started, 1), bytes_moved=_progress.get(job_id, 0))
+        logging.info(f"Job {job_id} finished in {time.time() - started:.1f}s")
+    except Exception as e:
+        logging.error(f"Job {job_id} failed: {e}")
+        _update_job(job_id, status='failed', error=str(e), finished_at=_now(),
+                    duration=round(time.time() - started, 1), bytes_moved=_progress.get(job_id, 0))
+    finally:
+        metrics.finish_run(_runs.pop(job_id, None), status)
+        with _lock:
+            _active[ssh_host] -= 1
+            _slots[ssh_host] -= 1
+            _progress.pop(job_id, None)
+        _dispatch(ssh_host)
+
+
+def _queue_depth():
+    # Jobs waiting for a host slot plus those holding one but still waiting for a worker
+    with _lock:
+        hosts = set(_pending) | set(_slots)
+        return {(('ssh_host', host),): len(_pending.get(host, ())) + _slots.get(host, 0) - _active.get(host, 0)
+                for host in hosts}
+
+
+def _active_jobs():
+    with _lock:
+        return {(('ssh_host', host),): count for host, count in _active.items()}
+
+
+metrics.register_gauge('backup_jobs_queued', 'Jobs waiting for a worker or a host slot', _queue_depth)
+metrics.register_gauge('backup_jobs_active', 'Jobs currently running', _active_jobs)
+
+
+# Re-queue jobs left behind by a previous process. Jobs that were mid-run are run
+# again if their kind is resumable (up to JOB_MAX_RESUMES times) and marked failed
+# otherwise. Only the job kinds registered in this process are touched, since the
+# web app and the scheduler share the table.
+def recover_jobs():
+    kinds = list(JOB_HANDLERS)
+    placeholders = ','.join('?' * len(kinds))
+    resumable = [kind for kind in kinds if kind in RESUMABLE_KINDS]
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE jobs SET status = 'queued', phase = 'queued', resumes = resumes + 1 "
+                       f"WHERE status = 'running' AND resumes < ? AND kind IN ({','.join('?' * len(resumable))})",
+                       (JOB_MAX_RESUMES, *resumable))
+        if cursor.rowcount:
+            logging.info(f"Resuming {cursor.rowcount} jobs interrupted by a restart")
+        cursor.execute("UPDATE jobs SET status = 'failed', error = 'Interrupted by restart', finished_at = ? "
+                       f"WHERE status = 'running' AND kind IN ({placeholders})", (_now(), *kinds))
+        cursor.execute(f"SELECT id, ssh_host FROM jobs WHERE status = 'queued' AND kind IN ({placeholders}) "
+                       "ORDER BY id", kinds)
+        queued = cursor.fetchall()
+        conn.commit()
+
+    for job_id, ssh_host in queued:
+        _submit(job_id, ssh_host)
+    if queued:
+        logging.info(f"Re-queued {len(queued)} pending jobs")
@@ -0,0 +1,228 @@
+# metrics.py
+
+import time
+import logging
+import threading
+from datetime import datetime
+import db
+
+# Histogram buckets: throughput in bytes per second, durations in seconds
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-2, 11))  # 256 KiB/s .. 1 GiB/s
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400)
+
+HELP = {
+    'backup_runs_total': ('counter', 'Finished backup/restore runs by kind and status'),
+    'backup_phase_seconds_total': ('counter', 'Wall-clock seconds spent in each pipeline phase'),
+    'backup_phase_bytes_total': ('counter', 'Bytes moved while each pipeline phase was current'),
+    'backup_phase_throughput_bytes_per_second': ('histogram', 'Throughput of each pipeline phase per run'),
+    'backup_run_duration_seconds': ('histogram', 'Duration of whole runs by kind'),
+    's3_transfer_throughput_bytes_per_second': ('histogram', 'Throughput of completed S3 uploads'),
+    's3_transfer_retries_total': ('counter', 'S3 requests retried during uploads'),
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts, sum, count, buckets]
+_gauges = {}      # name -> (help, callable returning {labels: value})
+
+
+def init_metrics_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS metric_runs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        project_name TEXT NOT NULL,
+                        ssh_host TEXT NOT NULL,
+                        job_id INTEGER,
+                        status TEXT NOT NULL,
+                        started_at TEXT NOT NULL,
+                        finished_at TEXT NOT NULL,
+                        duration REAL NOT NULL,
+                        bytes INTEGER NOT NULL
+                    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS metric_phases (
+                        run_id INTEGER NOT NULL,
+                        phase TEXT NOT NULL,
+                        duration REAL NOT NULL,
+                        bytes INTEGER NOT NULL,
+                        throughput REAL,
+                        PRIMARY KEY (run_id, phase)
+                    )''')
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = (name, _labels(labels))
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets, **labels):
+    with _lock:
+        key = (name, _labels(labels))
+        histogram = _histograms.setdefault(key, [[0] * len(buckets), 0, 0, buckets])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def register_gauge(name, help_text, func):
+    # func() returns {labels dict as tuple of pairs: value}, read at scrape time
+    _gauges[name] = (help_text, func)
+
+
+# A run is one backup, restore or upload. Phases are sequential: a phase lasts
+# until the next set_phase call, and bytes are credited to the phase that is
+# current when they move. Work that overlaps (e.g. the database restore running
+# next to the file extraction) is counted in whichever phase is current.
+class Run:
+    def __init__(self, kind, project_name, ssh_host, job_id=None):
+        self.lock = threading.Lock()
+        self.kind = kind
+        self.project_name = project_name
+        self.ssh_host = ssh_host
+        self.job_id = job_id
+        self.started = time.time()
+        self.bytes = 0
+        self.phase = None
+        self.phase_started = self.started
+        self.phase_bytes = 0
+        self.phases = {}  # phase -> [seconds, bytes]
+
+    def _close_phase(self, now):
+        if self.phase:
+            totals = self.phases.setdefault(self.phase, [0.0, 0])
+            totals[0] += now - self.phase_started
+            totals[1] += self.phase_bytes
+
+
+def start_run(kind, project_name, ssh_host, job_id=None):
+    return Run(kind, project_name, ssh_host, job_id)
+
+
+def set_phase(run, phase):
+    if run is None:
+        return
+    with run.lock:
+        now = time.time()
+        run._close_phase(now)
+        run.phase, run.phase_started, run.phase_bytes = phase, now, 0
+
+
+def add_bytes(run, count):
+    if run is None:
+        return
+    with run.lock:
+        run.bytes += count
+        run.phase_bytes += count
+
+
+def finish_run(run, status):
+    # Close the last phase, update the process metrics and persist the run
+    if run is None:
+        return
+    with run.lock:
+        now = time.time()
+        run._close_phase(now)
+        run.phase = None
+        duration = now - run.started
+        phases = {phase: (seconds, count) for phase, (seconds, count) in run.phases.items()}
+
+    inc('backup_runs_total', kind=run.kind, status=status)
+    observe('backup_run_duration_seconds', duration, DURATION_BUCKETS, kind=run.kind)
+    for phase, (seconds, count) in phases.items():
+        inc('backup_phase_seconds_total', seconds, kind=run.kind, phase=phase)
+        inc('backup_phase_bytes_total', count, kind=run.kind, phase=phase)
+        if count and seconds:
+            observe('backup_phase_throughput_bytes_per_second', count / seconds, THROUGHPUT_BUCKETS,
+                    kind=run.kind, phase=phase)
+
+    try:
+        with db.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''INSERT INTO metric_runs (kind, project_name, ssh_host, job_id, status, started_at,
+                                  finished_at, duration, bytes)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (run.kind, run.project_name, run.ssh_host, run.job_id, status,
+                            datetime.fromtimestamp(run.started).strftime('%Y-%m-%d %H:%M:%S'),
+                            datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'), round(duration, 2), run.bytes))
+            run_id = cursor.lastrowid
+            cursor.executemany("INSERT INTO metric_phases (run_id, phase, duration, bytes, throughput) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               [(run_id, phase, round(seconds, 2), count, round(count / seconds) if seconds else None)
+                                for phase, (seconds, count) in phases.items()])
+            conn.commit()
+    except Exception as e:
+        # Metrics must never fail the run they describe
+        logging.error(f"Could not save metrics for {run.kind} of {run.project_name}: {e}")
+
+    summary = ', '.join(f"{phase} {seconds:.1f}s/{count}B" for phase, (seconds, count) in phases.items())
+    logging.info(f"{run.kind} of {run.project_name} on {run.ssh_host} {status} in {duration:.1f}s ({summary})")
+
+
+def history(project_name=None, ssh_host=None, kind=None, limit=50):
+    # Recent persisted runs, newest first, each with its phase breakdown
+    conditions = {'project_name': project_name, 'ssh_host': ssh_host, 'kind': kind}
+    conditions = {name: value for name, value in conditions.items() if value}
+    where = ' AND '.join(f"{name} = ?" for name in conditions) or '1'
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT * FROM metric_runs WHERE {where} ORDER BY id DESC LIMIT ?",
+                       (*conditions.values(), limit))
+        runs = [{column[0]: value for column, value in zip(cursor.description, row)} for row in cursor.fetchall()]
+        for run in runs:
+            cursor.execute("SELECT phase, duration, bytes, throughput FROM metric_phases WHERE run_id = ?",
+                           (run['id'],))
+            run['phases'] = {phase: {'duration': seconds, 'bytes': count, 'throughput': throughput}
+                             for phase, seconds, count, throughput in cursor.fetchall()}
+    return runs
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape_label(value):
+    # Label values include user input such as host names; the exposition format
+    # requires backslash, double quote and newline to be escaped
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels) + '}'
+
+
+def render():
+    # Prometheus text exposition format
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(value[0]), value[1], value[2], value[3]) for key, value in _histograms.items()}
+    lines = []
+    for name, (kind, help_text) in HELP.items():
+        series = counters if kind == 'counter' else histograms
+        keys = sorted(key for key in series if key[0] == name)
+        if not keys:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for key in keys:
+            labels = key[1]
+            if kind == 'counter':
+                lines.append(f"{name}{_format_labels(labels)} {_number(series[key])}")
+                continue
+            counts, total, count, buckets = series[key]
+            for bound, bucket_count in zip(buckets, counts):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', _number(bound)),))} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_number(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    for name, (help_text, func) in sorted(_gauges.items()):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for labels, value in sorted(func().items()):
+            lines.append(f"{name}{_format_labels(labels)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
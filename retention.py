@@ -0,0 +1,161 @@
+# retention.py
+
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+import db
+import catalog
+import chunk_store
+
+# Grandfather-father-son policy: keep the newest backup in each of the last N
+# hours/days/ISO weeks/months, plus the `last` most recent backups overall.
+RETENTION_POLICY = os.getenv('RETENTION_POLICY', 'last=3,hourly=24,daily=7,weekly=4,monthly=6')
+DELETE_BATCH_SIZE = 1000  # delete_objects limit
+# Unreferenced chunks uploaded or reused more recently than this are kept: a
+# running incremental backup has not written the manifest that references them yet
+CHUNK_GC_GRACE_HOURS = float(os.getenv('CHUNK_GC_GRACE_HOURS', '24'))
+
+PERIOD_FORMATS = {
+    'hourly': '%Y-%m-%d %H',
+    'daily': '%Y-%m-%d',
+    'weekly': '%G-W%V',
+    'monthly': '%Y-%m',
+}
+
+
+def parse_policy(value):
+    policy = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, count = item.split('=', 1)
+            name = name.strip()
+            if name != 'last' and name not in PERIOD_FORMATS:
+                raise ValueError(f"Unknown retention period: {name}")
+            policy[name] = int(count)
+    return policy
+
+
+DEFAULT_POLICY = parse_policy(RETENTION_POLICY)
+
+
+def select_expired(backups, policy):
+    # backups: list of (key, datetime); returns the keys the policy does not keep
+    backups = sorted(backups, key=lambda backup: backup[1], reverse=True)
+    keep = {key for key, _ in backups[:max(policy.get('last', 0), 1)]}
+    for period, fmt in PERIOD_FORMATS.items():
+        limit = policy.get(period, 0)
+        seen = set()
+        for key, timestamp in backups:
+            bucket = timestamp.strftime(fmt)
+            if bucket in seen:
+                continue
+            if len(seen) >= limit:
+                break
+            seen.add(bucket)
+            keep.add(key)
+    return [key for key, _ in backups if key not in keep]
+
+
+def _catalog_backups(prefix):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT project, key, last_modified FROM catalog WHERE substr(key, 1, ?) = ?",
+                       (len(prefix), prefix))
+        projects = {}
+        for project, key, last_modified in cursor.fetchall():
+            projects.setdefault(project, []).append((key, datetime.strptime(last_modified, '%Y-%m-%d %H:%M:%S')))
+    return projects
+
+
+def delete_objects(s3_client, bucket, keys):
+    # Batched deletes; returns the keys S3 confirmed
+    deleted = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        response = s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in batch],
+            'Quiet': True,
+        })
+        errors = response.get('Errors', [])
+        for error in errors:
+            logging.error(f"Failed to delete {error['Key']}: {error.get('Message')}")
+        failed = {error['Key'] for error in errors}
+        deleted.extend(key for key in batch if key not in failed)
+    return deleted
+
+
+def delete_keys(s3_client, bucket, keys):
+    # Only keys S3 confirms are removed from the local catalog. Database dumps of
+    # streamed backups go with their archive (missing keys are a no-op).
+    deleted = delete_objects(s3_client, bucket, keys + [f"{key}{catalog.DB_ARCHIVE_SUFFIX}" for key in keys])
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("DELETE FROM catalog WHERE key = ?", [(key,) for key in deleted])
+        cursor.executemany("DELETE FROM backups WHERE backup_path = ?", [(key,) for key in deleted])
+        conn.commit()
+    return [key for key in deleted if not key.endswith(catalog.DB_ARCHIVE_SUFFIX)]
+
+
+def collect_chunks(s3_client, bucket, grace_hours=CHUNK_GC_GRACE_HOURS):
+    # Mark and sweep over the chunk store: every manifest in the bucket marks its
+    # chunks, and the unmarked ones past the grace period are deleted together
+    # with their rows, so later backups upload them again instead of skipping them
+    referenced = set()
+    stored = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        for obj in page.get('Contents', []):
+            if obj['Key'].startswith(chunk_store.CHUNK_PREFIX):
+                stored[obj['Key'].rsplit('/', 1)[-1]] = obj
+            elif obj['Key'].endswith(chunk_store.MANIFEST_EXTENSION):
+                manifest = chunk_store.load_manifest(s3_client, bucket, obj['Key'])
+                for entry in manifest['entries']:
+                    referenced.update(entry.get('chunks', ()))
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=grace_hours)
+    candidates = [digest for digest, obj in stored.items()
+                  if digest not in referenced and obj['LastModified'] < cutoff]
+    if not candidates:
+        return []
+    # Each batch holds the write lock while its rows and objects go, so a backup
+    # reusing one of those chunks waits, then finds no row and uploads it again
+    local_cutoff = (datetime.now() - timedelta(hours=grace_hours)).strftime('%Y-%m-%d %H:%M:%S')
+    deleted = []
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(candidates), DELETE_BATCH_SIZE):
+            batch = candidates[start:start + DELETE_BATCH_SIZE]
+            cursor.execute("BEGIN IMMEDIATE")
+            placeholders = ', '.join('?' * len(batch))
+            cursor.execute(f"SELECT hash FROM chunks WHERE hash IN ({placeholders}) "
+                           "AND COALESCE(last_used, created_at) >= ?", (*batch, local_cutoff))
+            recent = {row[0] for row in cursor.fetchall()}
+            batch = [digest for digest in batch if digest not in recent]
+            cursor.executemany("DELETE FROM chunks WHERE hash = ?", [(digest,) for digest in batch])
+            deleted.extend(delete_objects(s3_client, bucket, [stored[digest]['Key'] for digest in batch]))
+            conn.commit()
+    logging.info(f"Chunk sweep: {len(referenced)} chunks referenced, {len(deleted)} unreferenced chunks deleted")
+    return deleted
+
+
+def run_retention(s3_client, bucket, prefix, policies=None, projects=None, dry_run=False):
+    # One pass over every project in the catalog (or only `projects`), using a
+    # per-project policy from `policies` when given
+    policies = policies or {}
+    catalog.refresh(s3_client, bucket, prefix)
+    expired = []
+    for project, backups in sorted(_catalog_backups(prefix).items()):
+        if projects is not None and project not in projects:
+            continue
+        project_expired = select_expired(backups, policies.get(project, DEFAULT_POLICY))
+        if project_expired:
+            logging.info(f"Retention: {len(project_expired)} of {len(backups)} backups expired for {project}")
+        expired.extend(project_expired)
+
+    if dry_run or not expired:
+        return expired
+    deleted = delete_keys(s3_client, bucket, expired)
+    logging.info(f"Retention pass deleted {len(deleted)} backups")
+    if any(key.endswith(chunk_store.MANIFEST_EXTENSION) for key in deleted):
+        collect_chunks(s3_client, bucket)
+    return deleted
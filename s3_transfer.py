@@ -0,0 +1,285 @@
+# s3_transfer.py
+
+import os
+import time
+import base64
+import random
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+import db
+import metrics
+
+# Transfer tuning. Peak memory for a file upload is about part size * concurrency.
+S3_PART_SIZE = int(os.getenv('S3_PART_SIZE', str(16 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '8'))
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', '5'))
+# Whole-file upload attempts; each one resumes from the parts the previous one completed
+S3_UPLOAD_ATTEMPTS = int(os.getenv('S3_UPLOAD_ATTEMPTS', '3'))
+S3_ABANDONED_UPLOAD_HOURS = int(os.getenv('S3_ABANDONED_UPLOAD_HOURS', '24'))
+
+# Errors that retrying cannot fix
+FATAL_ERROR_CODES = ('NoSuchUpload', 'NoSuchBucket', 'AccessDenied', 'InvalidAccessKeyId')
+
+
+def init_transfer_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS s3_transfers (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        bucket TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        file_path TEXT,
+                        file_size INTEGER,
+                        file_mtime REAL,
+                        part_size INTEGER NOT NULL,
+                        upload_id TEXT,
+                        status TEXT NOT NULL,
+                        bytes INTEGER NOT NULL DEFAULT 0,
+                        parts INTEGER NOT NULL DEFAULT 0,
+                        resumed_parts INTEGER NOT NULL DEFAULT 0,
+                        retries INTEGER NOT NULL DEFAULT 0,
+                        duration REAL,
+                        throughput REAL,
+                        created_at TEXT NOT NULL,
+                        finished_at TEXT
+                    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS s3_transfer_parts (
+                        transfer_id INTEGER NOT NULL,
+                        part_number INTEGER NOT NULL,
+                        etag TEXT NOT NULL,
+                        checksum TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        PRIMARY KEY (transfer_id, part_number)
+                    )''')
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def checksum(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+class TransferStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.bytes = 0
+        self.parts = 0
+        self.resumed_parts = 0
+        self.retries = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        duration = time.time() - self.started
+        return {'bytes': self.bytes, 'parts': self.parts, 'resumed_parts': self.resumed_parts,
+                'retries': self.retries, 'duration': round(duration, 2),
+                'throughput': round(self.bytes / duration) if duration else None}
+
+
+def with_retries(func, stats=None, attempts=S3_MAX_ATTEMPTS):
+    # Exponential backoff with jitter for transient S3/network failures
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in FATAL_ERROR_CODES or attempt == attempts:
+                raise
+            error = e
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            error = e
+        if stats:
+            stats.add(retries=1)
+        delay = min(2 ** attempt * 0.5, 30) + random.uniform(0, 0.5)
+        logging.warning(f"S3 request failed (attempt {attempt}/{attempts}), retrying in {delay:.1f}s: {error}")
+        time.sleep(delay)
+
+
+def upload_part(s3_client, bucket, key, upload_id, part_number, data, stats=None):
+    digest = checksum(data)
+    response = with_retries(lambda: s3_client.upload_part(
+        Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data,
+        ChecksumAlgorithm='SHA256', ChecksumSHA256=digest), stats)
+    return {'PartNumber': part_number, 'ETag': response['ETag'], 'ChecksumSHA256': digest}
+
+
+def create_multipart_upload(s3_client, bucket, key):
+    return s3_client.create_multipart_upload(Bucket=bucket, Key=key, ChecksumAlgorithm='SHA256')['UploadId']
+
+
+def start_transfer(bucket, key, part_size, upload_id=None, file_path=None, file_size=None, file_mtime=None):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO s3_transfers (bucket, key, file_path, file_size, file_mtime, part_size,
+                              upload_id, status, created_at)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, 'in_progress', ?)''',
+                       (bucket, key, file_path, file_size, file_mtime, part_size, upload_id, _now()))
+        transfer_id = cursor.lastrowid
+        conn.commit()
+    return transfer_id
+
+
+def record_part(transfer_id, part, size):
+    with db.connect() as conn:
+        conn.execute("INSERT OR REPLACE INTO s3_transfer_parts (transfer_id, part_number, etag, checksum, size) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (transfer_id, part['PartNumber'], part['ETag'], part['ChecksumSHA256'], size))
+        conn.commit()
+
+
+def finish_transfer(transfer_id, status, stats):
+    result = stats.as_dict()
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''UPDATE s3_transfers SET status = ?, bytes = ?, parts = ?, resumed_parts = ?, retries = ?,
+                              duration = ?, throughput = ?, finished_at = ? WHERE id = ?''',
+                       (status, result['bytes'], result['parts'], result['resumed_parts'], result['retries'],
+                        result['duration'], result['throughput'], _now(), transfer_id))
+        if status == 'completed':
+            cursor.execute("DELETE FROM s3_transfer_parts WHERE transfer_id = ?", (transfer_id,))
+        conn.commit()
+    if status == 'completed' and result['throughput']:
+        metrics.observe('s3_transfer_throughput_bytes_per_second', result['throughput'], metrics.THROUGHPUT_BUCKETS)
+    if stats.retries:
+        metrics.inc('s3_transfer_retries_total', stats.retries)
+    return result
+
+
+def _find_resumable(bucket, key, file_path, file_size, file_mtime, part_size):
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT id, upload_id FROM s3_transfers
+                          WHERE bucket = ? AND key = ? AND file_path = ? AND file_size = ? AND file_mtime = ?
+                              AND part_size = ? AND status = 'in_progress' AND upload_id IS NOT NULL
+                          ORDER BY id DESC LIMIT 1''', (bucket, key, file_path, file_size, file_mtime, part_size))
+        row = cursor.fetchone()
+        parts = {}
+        if row:
+            cursor.execute("SELECT part_number, etag, checksum, size FROM s3_transfer_parts WHERE transfer_id = ?",
+                           (row[0],))
+            parts = {number: ({'PartNumber': number, 'ETag': etag, 'ChecksumSHA256': digest}, size)
+                     for number, etag, digest, size in cursor.fetchall()}
+    return row, parts
+
+
+def _uploaded_parts(s3_client, bucket, key, upload_id):
+    # Part numbers S3 actually holds for an upload; raises if the upload was aborted
+    numbers = set()
+    for page in s3_client.get_paginator('list_parts').paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        numbers.update(part['PartNumber'] for part in page.get('Parts', []))
+    return numbers
+
+
+def upload_file(s3_client, file_path, bucket, key, callback=None, part_size=S3_PART_SIZE,
+                max_concurrency=S3_MAX_CONCURRENCY, attempts=S3_UPLOAD_ATTEMPTS):
+    # Upload a local file; multipart uploads are persisted part by part, so a
+    # failed attempt is retried from its last part, and a later call for the
+    # same file and key (e.g. a job resumed after a restart) does the same
+    attempt = [0]
+
+    def run():
+        attempt[0] += 1
+        # Parts resumed from an earlier attempt of this call were already reported
+        return _upload_file(s3_client, file_path, bucket, key, callback, part_size, max_concurrency,
+                            report_resumed=attempt[0] == 1)
+
+    return with_retries(run, attempts=attempts)
+
+
+def _upload_file(s3_client, file_path, bucket, key, callback, part_size, max_concurrency, report_resumed):
+    stat = os.stat(file_path)
+    stats = TransferStats()
+
+    if stat.st_size <= part_size:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        transfer_id = start_transfer(bucket, key, part_size, file_path=file_path, file_size=stat.st_size,
+                                     file_mtime=stat.st_mtime)
+        with_retries(lambda: s3_client.put_object(Bucket=bucket, Key=key, Body=data,
+                                                  ChecksumAlgorithm='SHA256', ChecksumSHA256=checksum(data)), stats)
+        stats.add(bytes=len(data), parts=1)
+        if callback:
+            callback(len(data))
+        result = finish_transfer(transfer_id, 'completed', stats)
+        logging.info(f"Uploaded {file_path} to s3://{bucket}/{key}: {result}")
+        return result
+
+    row, done = _find_resumable(bucket, key, file_path, stat.st_size, stat.st_mtime, part_size)
+    if row:
+        transfer_id, upload_id = row
+        try:
+            on_s3 = _uploaded_parts(s3_client, bucket, key, upload_id)
+            done = {number: part for number, part in done.items() if number in on_s3}
+            logging.info(f"Resuming upload of {file_path} with {len(done)} parts already uploaded")
+        except ClientError as e:
+            logging.warning(f"Cannot resume upload {upload_id}, starting over: {e}")
+            row = None
+    if not row:
+        upload_id = create_multipart_upload(s3_client, bucket, key)
+        transfer_id = start_transfer(bucket, key, part_size, upload_id, file_path, stat.st_size, stat.st_mtime)
+        done = {}
+
+    for part, size in done.values():
+        stats.add(bytes=size, parts=1, resumed_parts=1)
+        if callback and report_resumed:
+            callback(size)
+
+    def send(part_number):
+        with open(file_path, 'rb') as f:
+            f.seek((part_number - 1) * part_size)
+            data = f.read(part_size)
+        part = upload_part(s3_client, bucket, key, upload_id, part_number, data, stats)
+        record_part(transfer_id, part, len(data))
+        stats.add(bytes=len(data), parts=1)
+        if callback:
+            callback(len(data))
+        return part
+
+    part_count = -(-stat.st_size // part_size)
+    parts = [part for part, _ in done.values()]
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='s3-upload') as executor:
+            futures = [executor.submit(send, number) for number in range(1, part_count + 1) if number not in done]
+            for future in as_completed(futures):
+                parts.append(future.result())
+        parts.sort(key=lambda part: part['PartNumber'])
+        with_retries(lambda: s3_client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}), stats)
+    except Exception:
+        # Leave the upload and its recorded parts in place so the next attempt resumes
+        finish_transfer(transfer_id, 'in_progress', stats)
+        raise
+
+    result = finish_transfer(transfer_id, 'completed', stats)
+    logging.info(f"Uploaded {file_path} to s3://{bucket}/{key}: {result}")
+    return result
+
+
+def cleanup_abandoned_uploads(s3_client, bucket, prefix='', older_than_hours=S3_ABANDONED_UPLOAD_HOURS):
+    # Abort multipart uploads nobody completed, which otherwise keep billing for their parts
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=older_than_hours)
+    aborted = []
+    for page in s3_client.get_paginator('list_multipart_uploads').paginate(Bucket=bucket, Prefix=prefix):
+        for upload in page.get('Uploads', []):
+            if upload['Initiated'] < cutoff:
+                s3_client.abort_multipart_upload(Bucket=bucket, Key=upload['Key'], UploadId=upload['UploadId'])
+                aborted.append(upload['UploadId'])
+    if aborted:
+        with db.connect() as conn:
+            conn.executemany("UPDATE s3_transfers SET status = 'aborted', finished_at = ? WHERE upload_id = ?",
+                             [(_now(), upload_id) for upload_id in aborted])
+            conn.executemany("DELETE FROM s3_transfer_parts WHERE transfer_id IN "
+                             "(SELECT id FROM s3_transfers WHERE upload_id = ?)",
+                             [(upload_id,) for upload_id in aborted])
+            conn.commit()
+    logging.info(f"Aborted {len(aborted)} abandoned multipart uploads older than {older_than_hours}h")
+    return aborted
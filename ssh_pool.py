@@ -0,0 +1,135 @@
+# ssh_pool.py
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import paramiko
+
+# Pool configuration
+SSH_POOL_MAX_SESSIONS = int(os.getenv('SSH_POOL_MAX_SESSIONS', '4'))  # per host
+SSH_POOL_IDLE_TIMEOUT = int(os.getenv('SSH_POOL_IDLE_TIMEOUT', '300'))  # seconds
+SSH_KEEPALIVE_INTERVAL = int(os.getenv('SSH_KEEPALIVE_INTERVAL', '30'))  # seconds
+
+_cond = threading.Condition()
+_idle = {}     # (host, user, key) -> list of (client, last_used)
+_in_use = {}   # (host, user, key) -> number of borrowed clients
+_reaper = None
+
+metrics = {'hits': 0, 'misses': 0, 'evictions': 0, 'health_check_failures': 0}
+
+
+def _connect(ssh_host, username, key_filename):
+    # "host:port" connects to a non-standard port; anything else (including IPv6) uses port 22
+    hostname, port = ssh_host, 22
+    if ssh_host.count(':') == 1 and ssh_host.split(':')[1].isdigit():
+        hostname, port = ssh_host.split(':')[0], int(ssh_host.split(':')[1])
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname, port=port, username=username, key_filename=key_filename)
+    client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+    logging.info(f"Connected to {ssh_host} as {username}")
+    return client
+
+
+def _is_healthy(client):
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        transport.send_ignore()
+    except Exception:
+        return False
+    return True
+
+
+def _evict_idle_locked(now):
+    for key, idle in _idle.items():
+        for entry in [entry for entry in idle if now - entry[1] > SSH_POOL_IDLE_TIMEOUT]:
+            idle.remove(entry)
+            entry[0].close()
+            metrics['evictions'] += 1
+            logging.info(f"Closed idle SSH connection to {key[0]}")
+
+
+def _reap():
+    while True:
+        time.sleep(max(SSH_POOL_IDLE_TIMEOUT / 2, 1))
+        with _cond:
+            _evict_idle_locked(time.time())
+
+
+def _start_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=_reap, name='ssh-pool-reaper', daemon=True)
+        _reaper.start()
+
+
+def acquire(ssh_host, username, key_filename):
+    key = (ssh_host, username, key_filename)
+    with _cond:
+        _start_reaper()
+        while True:
+            _evict_idle_locked(time.time())
+            idle = _idle.get(key, [])
+            while idle:
+                client, _ = idle.pop()
+                if _is_healthy(client):
+                    metrics['hits'] += 1
+                    _in_use[key] = _in_use.get(key, 0) + 1
+                    return client
+                metrics['health_check_failures'] += 1
+                client.close()
+            if _in_use.get(key, 0) < SSH_POOL_MAX_SESSIONS:
+                metrics['misses'] += 1
+                _in_use[key] = _in_use.get(key, 0) + 1
+                break
+            _cond.wait()
+
+    # Connect outside the lock so a slow handshake does not block other hosts
+    try:
+        return _connect(ssh_host, username, key_filename)
+    except Exception:
+        with _cond:
+            _in_use[key] -= 1
+            _cond.notify_all()
+        raise
+
+
+def release(ssh_host, username, key_filename, client):
+    key = (ssh_host, username, key_filename)
+    with _cond:
+        _in_use[key] -= 1
+        transport = client.get_transport()
+        if transport is not None and transport.is_active():
+            _idle.setdefault(key, []).append((client, time.time()))
+        else:
+            client.close()
+        _cond.notify_all()
+
+
+@contextmanager
+def connection(ssh_host, username, key_filename):
+    client = acquire(ssh_host, username, key_filename)
+    try:
+        yield client
+    finally:
+        release(ssh_host, username, key_filename, client)
+
+
+def pool_stats():
+    with _cond:
+        hosts = {}
+        for key in set(_idle) | set(_in_use):
+            hosts[key[0]] = {'idle': len(_idle.get(key, [])), 'in_use': _in_use.get(key, 0)}
+        return dict(metrics, hosts=hosts)
+
+
+def close_all():
+    with _cond:
+        for idle in _idle.values():
+            for client, _ in idle:
+                client.close()
+        _idle.clear()
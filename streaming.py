@@ -0,0 +1,116 @@
+# streaming.py
+
+import os
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import s3_transfer
+
+# Multipart part size (S3 minimum is 5 MiB) and the number of parts buffered or
+# uploading at once. Peak memory is roughly part size * (in-flight parts + 1).
+STREAM_PART_SIZE = int(os.getenv('STREAM_PART_SIZE', str(16 * 1024 * 1024)))
+STREAM_MAX_IN_FLIGHT = int(os.getenv('STREAM_MAX_IN_FLIGHT', '4'))
+
+
+def read_chunk(stream, size):
+    # Channel reads may return short; keep reading until the chunk is full or EOF
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        data = stream.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+def stream_to_s3(s3_client, stream, bucket, key, part_size=STREAM_PART_SIZE,
+                 max_in_flight=STREAM_MAX_IN_FLIGHT, callback=None, verify=None):
+    # Upload a file-like stream of unknown length to S3 as a multipart upload.
+    # `verify` is called once the stream is drained and may raise to abort the upload.
+    # Parts carry SHA-256 checksums and are retried individually; a stream cannot be
+    # re-read, so unlike s3_transfer.upload_file an interrupted upload is aborted.
+    upload_id = s3_transfer.create_multipart_upload(s3_client, bucket, key)
+    transfer_id = s3_transfer.start_transfer(bucket, key, part_size, upload_id)
+    stats = s3_transfer.TransferStats()
+    slots = threading.BoundedSemaphore(max_in_flight)
+    futures = []
+    total_bytes = 0
+
+    def upload_part(part_number, data):
+        try:
+            part = s3_transfer.upload_part(s3_client, bucket, key, upload_id, part_number, data, stats)
+            stats.add(bytes=len(data), parts=1)
+            if callback:
+                callback(len(data))
+            return part
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            part_number = 1
+            while True:
+                slots.acquire()
+                data = read_chunk(stream, part_size)
+                if not data and part_number > 1:
+                    slots.release()
+                    break
+                # Stop reading early if a part upload has already failed
+                for future in futures:
+                    if future.done() and future.exception():
+                        slots.release()
+                        raise future.exception()
+                futures.append(executor.submit(upload_part, part_number, data))
+                total_bytes += len(data)
+                part_number += 1
+                if len(data) < part_size:
+                    break
+
+        parts = [future.result() for future in futures]
+        if verify:
+            verify()
+        s3_transfer.with_retries(lambda: s3_client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}), stats)
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        s3_transfer.finish_transfer(transfer_id, 'aborted', stats)
+        raise
+
+    result = s3_transfer.finish_transfer(transfer_id, 'completed', stats)
+    logging.info(f"Streamed {total_bytes} bytes to s3://{bucket}/{key} in {len(futures)} parts: {result}")
+    return total_bytes
+
+
+def stream_from_s3(s3_client, bucket, key, sink, part_size=STREAM_PART_SIZE,
+                   max_in_flight=STREAM_MAX_IN_FLIGHT, callback=None):
+    # Download an S3 object with parallel ranged GETs and write the ranges to
+    # `sink` in order. At most `max_in_flight` ranges are held in memory.
+    size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    ranges = iter([(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)])
+
+    def fetch(byte_range):
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={byte_range[0]}-{byte_range[1]}")
+        return response['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = deque(executor.submit(fetch, byte_range) for byte_range in islice(ranges, max_in_flight))
+        try:
+            while pending:
+                data = pending.popleft().result()
+                sink.write(data)
+                if callback:
+                    callback(len(data))
+                byte_range = next(ranges, None)
+                if byte_range:
+                    pending.append(executor.submit(fetch, byte_range))
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+
+    logging.info(f"Streamed {size} bytes from s3://{bucket}/{key}")
+    return size
@@ -0,0 +1,185 @@
+# zip_stream.py
+
+import os
+import time
+import zlib
+import struct
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+# Files up to ZIP_INLINE_MAX are read and compressed whole on the reader pool;
+# larger ones are streamed by the writer in ZIP_CHUNK_SIZE pieces. Peak memory
+# is about ZIP_INLINE_MAX * ZIP_PREFETCH regardless of the size of the tree.
+ZIP_READ_WORKERS = int(os.getenv('ZIP_READ_WORKERS', str(min(32, (os.cpu_count() or 1) * 4))))
+ZIP_PREFETCH = int(os.getenv('ZIP_PREFETCH', str(ZIP_READ_WORKERS * 2)))
+ZIP_INLINE_MAX = int(os.getenv('ZIP_INLINE_MAX', str(1024 * 1024)))
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+STORED, DEFLATED = 0, 8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+# Sizes, offsets and entry counts from these limits on need zip64 records; the
+# classic fields then hold the all-ones markers
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+MARKER, COUNT_MARKER = 0xFFFFFFFF, 0xFFFF
+
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, 1 << 5 | 1  # 1980-01-01, the earliest date a zip can hold
+    return t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2, (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+
+
+class ZipStreamWriter:
+    # Writes a zip archive front to back without seeking, so the target can be
+    # a pipe or an upload stream. Entries are either already compressed (see
+    # compress_file) or streamed with a data descriptor after their contents.
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.entries = []  # central directory records
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _local_header(self, name, flags, method, mtime, crc, compress_size, size, extra=b''):
+        dos_time, dos_date = _dos_time(mtime)
+        version = 45 if extra else 20
+        self._write(struct.pack('<4s2B4HL2L2H', b'PK\x03\x04', version, 0, flags, method, dos_time, dos_date,
+                                crc, compress_size, size, len(name), len(extra)) + name + extra)
+
+    def add_compressed(self, arcname, data, crc, size, method, mtime, mode=0o644):
+        # `data` is `size` bytes compressed with `method`, as returned by compress_file
+        name, flags = self._name(arcname)
+        offset = self.offset
+        if len(data) >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            self._local_header(name, flags, method, mtime, crc, MARKER, MARKER,
+                               struct.pack('<2HQQ', 1, 16, size, len(data)))
+        else:
+            self._local_header(name, flags, method, mtime, crc, len(data), size)
+        self._write(data)
+        self.entries.append((name, flags, method, mtime, crc, len(data), size, offset, mode))
+
+    def add_stream(self, arcname, reader, level=None, mtime=None, mode=0o644):
+        # Copy a file-like of unknown length into the archive in chunks; sizes
+        # and CRC follow the contents in a zip64 data descriptor
+        name, flags = self._name(arcname)
+        flags |= FLAG_DATA_DESCRIPTOR
+        method = DEFLATED if level else STORED
+        mtime = time.time() if mtime is None else mtime
+        offset = self.offset
+        self._local_header(name, flags, method, mtime, 0, MARKER, MARKER, struct.pack('<2HQQ', 1, 16, 0, 0))
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if level else None
+        crc = size = compress_size = 0
+        while True:
+            chunk = reader.read(ZIP_CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            compress_size += len(chunk)
+            self._write(chunk)
+        if compressor:
+            tail = compressor.flush()
+            compress_size += len(tail)
+            self._write(tail)
+        self._write(struct.pack('<4sLQQ', b'PK\x07\x08', crc, compress_size, size))
+        self.entries.append((name, flags, method, mtime, crc, compress_size, size, offset, mode))
+        return size
+
+    def _name(self, arcname):
+        try:
+            return arcname.encode('ascii'), 0
+        except UnicodeEncodeError:
+            return arcname.encode('utf-8'), FLAG_UTF8
+
+    def close(self):
+        start = self.offset
+        for name, flags, method, mtime, crc, compress_size, size, offset, mode in self.entries:
+            dos_time, dos_date = _dos_time(mtime)
+            zip64 = [value for value in (size, compress_size, offset) if value >= ZIP64_LIMIT]
+            extra = struct.pack(f'<2H{len(zip64)}Q', 1, 8 * len(zip64), *zip64) if zip64 else b''
+            version = 45 if extra or flags & FLAG_DATA_DESCRIPTOR else 20
+            self._write(struct.pack('<4s4B4HL2L5H2L', b'PK\x01\x02', version, 3, version, 0, flags, method,
+                                    dos_time, dos_date, crc, MARKER if compress_size >= ZIP64_LIMIT else compress_size,
+                                    MARKER if size >= ZIP64_LIMIT else size, len(name), len(extra), 0, 0, 0,
+                                    (0o100000 | mode) << 16, MARKER if offset >= ZIP64_LIMIT else offset) + name + extra)
+        size = self.offset - start
+        count = len(self.entries)
+        if count >= ZIP64_COUNT_LIMIT or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            zip64_end = self.offset
+            self._write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, size, start))
+            self._write(struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_end, 1))
+            count, size, start = COUNT_MARKER, MARKER, MARKER
+        self._write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count, count, size, start, 0))
+        self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+
+
+def scan_tree(source_dir, skip=None):
+    # (path, arcname) for every file under source_dir; like os.walk, symlinked
+    # directories are not descended into
+    stack = [source_dir]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and not (skip and skip(entry.name)):
+                    yield entry.path, os.path.relpath(entry.path, source_dir)
+
+
+def compress_file(path, level=None):
+    # Read and compress one file on a pool thread (zlib releases the GIL); files
+    # too large to hold in memory come back as (stat, None) for the writer to stream
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size > ZIP_INLINE_MAX:
+            return stat, None
+        data = f.read()
+    crc = zlib.crc32(data)
+    if level:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return stat, (compressor.compress(data) + compressor.flush(), crc, len(data), DEFLATED)
+    return stat, (data, crc, len(data), STORED)
+
+
+def add_tree(writer, source_dir, level=None, skip=None, workers=ZIP_READ_WORKERS, prefetch=ZIP_PREFETCH):
+    # Files are opened, read and compressed ZIP_PREFETCH at a time on a thread
+    # pool and written in scan order; returns the number of files added
+    files = scan_tree(source_dir, skip)
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zip-read') as executor:
+        pending = deque((arcname, path, executor.submit(compress_file, path, level))
+                        for path, arcname in islice(files, prefetch))
+        try:
+            while pending:
+                arcname, path, future = pending.popleft()
+                stat, compressed = future.result()
+                if compressed:
+                    writer.add_compressed(arcname, *compressed, stat.st_mtime, stat.st_mode & 0o7777)
+                else:
+                    with open(path, 'rb') as f:
+                        writer.add_stream(arcname, f, level, stat.st_mtime, stat.st_mode & 0o7777)
+                count += 1
+                for path, arcname in islice(files, 1):
+                    pending.append((arcname, path, executor.submit(compress_file, path, level)))
+        except Exception:
+            for _, _, future in pending:
+                future.cancel()
+            raise
+    return count